@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import importlib
+import traceback
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+from instrumentation import io_bytes
+
+# Benchmarks every stage of the pipeline on synthetic phantoms: a CT with ellipsoidal bones (cortical shell around
+# the marrow) inside an elliptic body, its bone label map with the TotalSegmentator label table, and a SPECT with
+# uptake in the bones and hot lesions. Runs offline on a CPU, the RTSTRUCT export is only timed when rt_utils is installed.
+# Each stage runs in a fresh process, timed on the outputs of the stages before it, and the results are written as JSON.
+
+CT_SPACING = (0.98, 0.98, 2.5)
+SPECT_SPACING = (4.8, 4.8, 4.8)
+# HU of the body, the cortical shell and the marrow, and the relative radius where the shell starts
+BODY_HU = 40
+CORTICAL_HU = 1200
+MARROW_HU = 250
+SHELL_START = 0.6
+LESION_UPTAKE = 60
+SLAB_SLICES = 32
+
+STAGE_NAMES = ['label_split', 'resize_spect_to_ct', 'snr_metastasis', 'full_pipeline', 'subtract_metastasis',
+               'combine_bone_marrow', 'nifti_to_rtstruct']
+
+# CT (int16 HU), bone label map (uint8, label i is bone_names[i - 1]) and SPECT (float32) of one synthetic study,
+# with their affines. Bones never overlap, lesions are centred on randomly picked bones
+def make_phantom(shape, bone_names, n_lesions=20, seed=0):
+    rng = np.random.default_rng(seed)
+    nx, ny, nz = shape
+    x, y = np.ogrid[:nx, :ny]
+    body = ((x - nx / 2) / (0.45 * nx)) ** 2 + ((y - ny / 2) / (0.35 * ny)) ** 2 <= 1
+    ct = np.empty(shape, dtype=np.int16)
+    for z_start in range(0, nz, SLAB_SLICES):
+        slab_shape = (nx, ny, min(SLAB_SLICES, nz - z_start))
+        noise = rng.standard_normal(slab_shape, dtype=np.float32) * 20
+        ct[:, :, z_start:z_start + slab_shape[2]] = np.where(body[:, :, np.newaxis], BODY_HU + noise, -1000)
+
+    label_array = np.zeros(shape, dtype=np.uint8)
+    centers = []
+    for label in range(1, len(bone_names) + 1):
+        semi_axes = rng.uniform([0.02 * nx, 0.02 * ny, 4], [0.08 * nx, 0.08 * ny, max(5, nz / 8)])
+        center = [nx / 2 + rng.uniform(-0.3, 0.3) * nx, ny / 2 + rng.uniform(-0.22, 0.22) * ny, rng.uniform(0, nz)]
+        bbox = tuple(slice(max(int(c - a), 0), min(int(c + a) + 1, n)) for c, a, n in zip(center, semi_axes, shape))
+        grid = np.ogrid[bbox]
+        distance = sum(((g - c) / a) ** 2 for g, c, a in zip(grid, center, semi_axes))
+        inside = (distance <= 1) & (label_array[bbox] == 0)
+        label_array[bbox][inside] = label
+        marrow = inside & (distance <= SHELL_START ** 2)
+        ct_box = ct[bbox]
+        ct_box[inside & ~marrow] = CORTICAL_HU
+        ct_box[marrow] = MARROW_HU + rng.integers(-50, 50, int(marrow.sum()))
+        centers.append(center)
+
+    # SPECT on its own coarser grid, covering the CT field of view
+    scale = np.array(SPECT_SPACING) / np.array(CT_SPACING)
+    spect_shape = tuple(int(np.ceil(n / s)) for n, s in zip(shape, scale))
+    indices = [np.minimum(np.round(np.arange(n) * s).astype(int), size - 1) for n, s, size in zip(spect_shape, scale, shape)]
+    spect = body[np.ix_(indices[0], indices[1])][:, :, np.newaxis] + (label_array[np.ix_(*indices)] > 0).astype(np.float32)
+    spect = spect.astype(np.float32) + rng.standard_normal(spect_shape, dtype=np.float32) * 0.2
+    grid = np.ogrid[tuple(slice(0, n) for n in spect_shape)]
+    for index in rng.choice(len(centers), size=min(n_lesions, len(centers)), replace=False):
+        center = np.array(centers[index]) / scale
+        spect += LESION_UPTAKE * np.exp(-sum((g - c) ** 2 for g, c in zip(grid, center)) / (2 * 1.5 ** 2)).astype(np.float32)
+
+    return ct, np.diag(CT_SPACING + (1,)), label_array, spect, np.diag(SPECT_SPACING + (1,))
+
+# Axial slices of the CT as a DICOM series, the reference of the RTSTRUCT export
+def write_dicom_series(ct, affine, output_dir):
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import generate_uid, ExplicitVRLittleEndian, CTImageStorage
+    os.makedirs(output_dir, exist_ok=True)
+    study_uid, series_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    for z in range(ct.shape[2]):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = Dataset()
+        ds.file_meta = file_meta
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID, ds.SeriesInstanceUID, ds.FrameOfReferenceUID = study_uid, series_uid, frame_uid
+        ds.Modality = 'CT'
+        ds.PatientName, ds.PatientID, ds.StudyID = 'Phantom', 'PHANTOM', 'BENCH'
+        ds.StudyDate = ds.SeriesDate = '20000101'
+        ds.StudyTime = ds.SeriesTime = '000000'
+        ds.SeriesNumber, ds.InstanceNumber = 1, z + 1
+        ds.ImagePositionPatient = [float(affine[0, 3]), float(affine[1, 3]), float(affine[2, 3] + z * affine[2, 2])]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [float(affine[1, 1]), float(affine[0, 0])]
+        ds.SliceThickness = float(affine[2, 2])
+        ds.Rows, ds.Columns = ct.shape[1], ct.shape[0]
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 1
+        ds.PixelData = np.ascontiguousarray(ct[:, :, z].T).tobytes()
+        ds.save_as(os.path.join(output_dir, f'{z:04d}.dcm'), enforce_file_format=True)
+
+# Writes the phantom study under study_dir with the names the pipeline gives its files, returns the paths of the stages
+def write_phantom_study(study_dir, shape, n_lesions=20, seed=0, dicom=True):
+    from bone_seg import bones
+    from segmentation_backends import add_label_table
+    os.makedirs(study_dir, exist_ok=True)
+    ct, ct_affine, label_array, spect, spect_affine = make_phantom(shape, bones, n_lesions, seed)
+    ct_path = os.path.join(study_dir, 'CT_phantom.nii.gz')
+    paths = {
+        'ct': ct_path,
+        'pt': os.path.join(study_dir, 'PT_phantom.nii.gz'),
+        'labels': os.path.join(study_dir, 'CT_phantom_totalseg.nii.gz'),
+        'segmentation_dir': ct_path.replace('.nii.gz', '_segmentation'),
+        'intermediate_dir': ct_path.replace('.nii.gz', '_intermediate'),
+        'marrow_dir': os.path.join(study_dir, 'marrow_segmentation'),
+        'dicom_dir': ct_path.replace('.nii.gz', '_DICOM'),
+    }
+    paths['resized'] = paths['pt'].replace('.nii.gz', '_resized.nii.gz')
+    paths['assembled'] = os.path.join(paths['marrow_dir'], 'assembled_marrow.nii.gz')
+    nib.save(nib.Nifti1Image(ct, ct_affine), paths['ct'])
+    nib.save(nib.Nifti1Image(spect, spect_affine), paths['pt'])
+    nib.save(add_label_table(nib.Nifti1Image(label_array, ct_affine), dict(enumerate(bones, start=1))), paths['labels'])
+    if dicom:
+        write_dicom_series(ct, ct_affine, paths['dicom_dir'])
+    return paths
+
+def _label_split(paths):
+    from bone_seg import split_label_map
+    from segmentation_backends import get_multilabel_nifti_header
+    os.makedirs(paths['segmentation_dir'], exist_ok=True)
+    masks, labels = get_multilabel_nifti_header(nib.load(paths['labels']))
+    split_label_map(masks, labels, paths['segmentation_dir'])
+
+def _resize_spect_to_ct(paths):
+    from spect_resizing import resize_spect_to_ct
+    resize_spect_to_ct(paths['pt'], paths['ct'], paths['resized'])
+
+def _snr_metastasis(paths):
+    from snr_metastasis import metastasis_detector
+    metastasis_detector(paths['resized'])(paths['resized'])
+
+def _full_pipeline(paths):
+    from thresholding_morphology import threshold_study
+    from utility_functions import VolumeCache
+    threshold_study(paths['ct'], paths['segmentation_dir'], paths['intermediate_dir'], volume_cache=VolumeCache(), use_cache=False)
+
+def _subtract_metastasis(paths):
+    from metastatis_exclusion import exclude_metastasis
+    from volume_storage import find_stored
+    exclude_metastasis(paths['intermediate_dir'], find_stored(paths['pt'].replace('.nii.gz', '_metastasis_snr.nii.gz')), paths['marrow_dir'])
+
+def _combine_bone_marrow(paths):
+    from nifti_to_rtstruct import combine_bone_marrow
+    combine_bone_marrow(paths['marrow_dir'], paths['assembled'])
+
+def _nifti_to_rtstruct(paths):
+    from nifti_to_rtstruct import nifti_to_rtstruct
+    nifti_to_rtstruct(paths['assembled'], paths['dicom_dir'], os.path.join(paths['marrow_dir'], 'phantom'), "BoneMarrow")
+
+STAGES = {
+    'label_split': _label_split,
+    'resize_spect_to_ct': _resize_spect_to_ct,
+    'snr_metastasis': _snr_metastasis,
+    'full_pipeline': _full_pipeline,
+    'subtract_metastasis': _subtract_metastasis,
+    'combine_bone_marrow': _combine_bone_marrow,
+    'nifti_to_rtstruct': _nifti_to_rtstruct,
+}
+
+# Modules of the stages, imported before a stage is measured so the import time isn't counted
+# (rt_utils and dicom_to_nifti are only imported by nifti_to_rtstruct when it writes an RTSTRUCT)
+STAGE_MODULES = ['bone_seg', 'spect_resizing', 'snr_metastasis', 'thresholding_morphology', 'metastatis_exclusion', 'nifti_to_rtstruct',
+                 'rt_utils', 'dicom_to_nifti']
+
+def _import_stage_modules():
+    for module in STAGE_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            # Reported by the stages that need it
+            pass
+
+# Runs one stage in the current process and measures it, ru_maxrss is in kilobytes on Linux and in bytes on macOS
+def _measure_stage(name, paths, verbose=False):
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    _import_stage_modules()
+    result = {'status': 'done', 'error': None}
+    read_start, written_start = io_bytes()
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            STAGES[name](paths)
+    except ImportError as e:
+        result.update(status='unavailable', error=str(e))
+    except Exception:
+        result.update(status='failed', error=traceback.format_exc())
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_end, written_end = io_bytes()
+    result.update(
+        wall_s=time.perf_counter() - wall_start,
+        cpu_s=time.process_time() - cpu_start + (children.ru_utime - children_start.ru_utime) + (children.ru_stime - children_start.ru_stime),
+        peak_rss_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit,
+        start_rss_bytes=rss_start,
+        peak_rss_children_bytes=children.ru_maxrss * rss_unit,
+        read_bytes=read_end - read_start,
+        written_bytes=written_end - written_start,
+    )
+    return result
+
+# Runs one stage in a fresh process, so its peak RSS is its own
+def run_stage(name, paths, verbose=False):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_measure_stage, name, paths, verbose).result()
+
+# Benchmarks the stages (all of STAGE_NAMES by default, in pipeline order) on phantoms of each shape
+# Returns the results as a dict, written to results_path as JSON when given
+def run_benchmarks(work_dir, shapes, stages=None, repeats=1, n_lesions=20, seed=0, results_path=None, verbose=False, keep_files=False):
+    stages = STAGE_NAMES if stages is None else stages
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cases': [],
+    }
+    for shape in shapes:
+        study_dir = os.path.join(work_dir, 'PHANTOM_' + 'x'.join(map(str, shape)))
+        t0 = time.perf_counter()
+        paths = write_phantom_study(study_dir, shape, n_lesions, seed, dicom='nifti_to_rtstruct' in stages)
+        case = {'shape': list(shape), 'n_lesions': n_lesions, 'seed': seed, 'setup_s': time.perf_counter() - t0, 'stages': {}}
+        print(f"Phantom {shape} written in {case['setup_s']:.1f} s")
+        for name in stages:
+            runs = [run_stage(name, paths, verbose) for _ in range(repeats)]
+            # The fastest run is the least disturbed by the rest of the machine
+            case['stages'][name] = dict(min(runs, key=lambda run: run['wall_s']), repeats=repeats)
+            stage = case['stages'][name]
+            print(f"{name}: {stage['status']}, {stage['wall_s']:.2f} s wall, {stage['cpu_s']:.2f} s CPU, "
+                  f"{stage['peak_rss_bytes'] / 1024**2:.0f} MiB peak RSS")
+        results['cases'].append(case)
+        if not keep_files:
+            shutil.rmtree(study_dir)
+    if results_path is not None:
+        with open(results_path, 'w') as f:
+            json.dump(results, f, indent=1)
+    return results
+
+# Stages of results slower (wall time) or bigger (peak RSS) than in the baseline results by more than tolerance
+# Returns a list of (shape, stage, metric, baseline value, new value)
+def compare_results(results, baseline, tolerance=0.2, metrics=('wall_s', 'peak_rss_bytes')):
+    baseline_cases = {tuple(case['shape']): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        baseline_case = baseline_cases.get(tuple(case['shape']))
+        if baseline_case is None:
+            continue
+        for name, stage in case['stages'].items():
+            baseline_stage = baseline_case['stages'].get(name)
+            if baseline_stage is None or stage['status'] != 'done' or baseline_stage['status'] != 'done':
+                continue
+            for metric in metrics:
+                if stage[metric] > baseline_stage[metric] * (1 + tolerance):
+                    regressions.append((tuple(case['shape']), name, metric, baseline_stage[metric], stage[metric]))
+    return regressions
+
+work_dir = os.path.join(tempfile.gettempdir(), 'bone_marrow_benchmark')
+results_path = 'benchmark_results.json'
+# Results of an earlier run to compare against, e.g. 'benchmark_baseline.json'
+baseline_path = None
+shapes = [(512, 512, 200), (512, 512, 900)]
+stages = None
+repeats = 1
+
+if __name__ == "__main__":
+    results = run_benchmarks(work_dir, shapes, stages, repeats, results_path=results_path)
+    print(f"Results written to {results_path}")
+    if baseline_path is not None:
+        with open(baseline_path) as f:
+            regressions = compare_results(results, json.load(f))
+        for shape, name, metric, old, new in regressions:
+            print(f"Regression in {name} {shape}: {metric} {old:.4g} -> {new:.4g}")
+        sys.exit(1 if regressions else 0)
@@ -1,8 +1,17 @@
 import os
+import queue
+import threading
+import traceback
+import numpy as np
 import nibabel as nib
-from totalsegmentator.python_api import totalsegmentator
-import xmltodict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import find_objects
 import time
+from segmentation_backends import get_backend, get_multilabel_nifti_header
+from study_catalog import open_catalog
+from instrumentation import span
+from volume_storage import MASK_FORMAT, save_mask, mask_image, stored_path, load_image
 
 
 
@@ -64,52 +73,149 @@ bones = [
     "vertebrae_T11",
     "vertebrae_T12"
 ]
-os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 
 
+# Reads the multilabel volume once as an integer array (no float64 promotion)
+def load_label_array(img):
+    label_array = np.asanyarray(img.dataobj)
+    if not np.issubdtype(label_array.dtype, np.integer):
+        label_array = np.rint(label_array).astype(np.uint16)
+    return label_array
 
-def get_multilabel_nifti_header(img):
-    ext_header = img.header.extensions[0].get_content()
-    ext_header = xmltodict.parse(ext_header)
-    ext_header = ext_header["CaretExtension"]["VolumeInformation"]["LabelTable"]["Label"]
-    if isinstance(ext_header, dict):
-        ext_header = [ext_header]
-        
-    label_map = {int(e["@Key"]): e["#text"] for e in ext_header}
-    return img, label_map
+# Threads writing the bone masks of a CT, each one holds a full-grid mask while it writes
+SPLIT_WORKERS = 4
 
-def segment_nifti_files(root_dir):
-    # Initialize the TotalSegmentator
+# Writes a single bone as a uint8 mask on the full grid of the CT, the stages downstream expect the CT shape
+# buffer, when given, is an all-False mask of that shape that is filled inside bbox only and cleared again after the write
+def save_bone_mask(label_array, label, bbox, header, affine, output_path, buffer=None):
+    mask = np.zeros(label_array.shape, dtype=bool) if buffer is None else buffer
+    # A bone absent from the scan gets an empty mask, which keeps the downstream file layout unchanged
+    if bbox is not None:
+        mask[bbox] = label_array[bbox] == label
+    try:
+        return save_mask(mask_image(mask, affine, header), output_path)
+    finally:
+        if buffer is not None and bbox is not None:
+            buffer[bbox] = False
+
+# Splits the multilabel volume into one mask per requested bone
+# The label array is read once and all bounding boxes are found in a single pass with find_objects,
+# each bone is then only compared inside its own bounding box and the masks are written by max_workers threads,
+# each reusing one full-grid buffer, so at most max_workers masks are allocated whatever the number of bones
+def split_label_map(masks, labels, output_dir, bone_list=bones, max_workers=SPLIT_WORKERS):
+    flipped_labels = {v: k for k, v in labels.items()}
+    label_array = load_label_array(masks)
+    bboxes = find_objects(label_array, max_label=max(flipped_labels[bone] for bone in bone_list))
+    buffers = threading.local()
+
+    def save(label, output_path):
+        if not hasattr(buffers, 'mask'):
+            buffers.mask = np.zeros(label_array.shape, dtype=bool)
+        return save_bone_mask(label_array, label, bboxes[label - 1], masks.header, masks.affine, output_path, buffers.mask)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for bone in bone_list:
+            futures.append(executor.submit(save, flipped_labels[bone], os.path.join(output_dir, f"{bone}.nii.gz")))
+        for future in futures:
+            print(f"Segmented file saved: {future.result()}")
+
+# Segments one CT and writes its bone masks to <CT name>_segmentation next to it
+# backend defaults to TotalSegmentator restricted to the bones (see segmentation_backends.py), image to the CT read from file_path
+# max_workers threads write the bone masks (see split_label_map)
+def segment_ct_file(file_path, backend=None, image=None, max_workers=SPLIT_WORKERS):
+    subdir, file = os.path.split(file_path)
+    print(f"Processing file: {file_path}")
+    segmented_file_path = os.path.join(subdir, f"{file.replace('.nii.gz','')}_segmentation")
+    if not os.path.exists(segmented_file_path):
+        os.makedirs(segmented_file_path)
+
+    if backend is None:
+        backend = get_backend("totalsegmentator", bones)
+    if image is None:
+        image = nib.load(file_path)
+    with span('segment', series=file):
+        masks_without_header, labels = backend.segment(image)
+    print(f"Labels: {labels}")
+    with span('split_label_map', series=file):
+        split_label_map(masks_without_header, labels, segmented_file_path, max_workers=max_workers)
+
+    # Save the segmented image
+    print(f"Segmented file saved: {segmented_file_path}")
+    return segmented_file_path
+
+# Reads a CT fully into memory, so the backend never goes back to the (compressed) file
+def decode_ct(file_path):
+    image, array = load_image(file_path, mmap=False)
+    return nib.Nifti1Image(array, image.affine, image.header)
+
+# Long-lived segmentation worker: the backend is set up once, then CTs are taken from a queue and segmented one after
+# the other, while up to prefetch of the next queued CTs are decoded in a reader thread
+class SegmentationWorker:
+    def __init__(self, backend=None, prefetch=1):
+        self.backend = get_backend("totalsegmentator", bones) if backend is None else backend
+        self.backend.load()
+        self.prefetch = prefetch
+
+    # Segments the CT paths put in ct_queue until None is put, calling on_segmented(ct_path, segmentation_dir) after each
+    # Returns a dict of CT path -> segmentation directory, and a dict of CT path -> traceback for the failed CTs
+    def serve(self, ct_queue, on_segmented=None):
+        segmented, errors = {}, {}
+        pending = deque()
+        closed = False
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            while pending or not closed:
+                # Queue the decode of the CTs waiting, only blocking for the next one when there is nothing to segment
+                while not closed and len(pending) <= self.prefetch:
+                    try:
+                        ct_path = ct_queue.get(block=not pending)
+                    except queue.Empty:
+                        break
+                    if ct_path is None:
+                        closed = True
+                    else:
+                        pending.append((ct_path, reader.submit(decode_ct, ct_path)))
+                if not pending:
+                    continue
+                ct_path, image = pending.popleft()
+                try:
+                    with span('wait_decode', series=os.path.basename(ct_path)):
+                        image = image.result()
+                    segmented[ct_path] = segment_ct_file(ct_path, self.backend, image)
+                    if on_segmented is not None:
+                        on_segmented(ct_path, segmented[ct_path])
+                except Exception:
+                    errors[ct_path] = traceback.format_exc()
+                    print(f"Failed to segment {ct_path}\n{errors[ct_path]}")
+        return segmented, errors
+
+    def segment_files(self, ct_paths, on_segmented=None):
+        ct_queue = queue.Queue()
+        for ct_path in ct_paths:
+            ct_queue.put(ct_path)
+        ct_queue.put(None)
+        return self.serve(ct_queue, on_segmented)
+
+def segment_nifti_files(root_dir, backend=None):
     # Walk through the directory tree
+    ct_paths = []
     for subdir, _, files in os.walk(root_dir):
         for file in files:
-            if file.endswith('.nii') or file.endswith('.nii.gz') and 'CT' in file:
-                file_path = os.path.join(subdir, file)
-                print(f"Processing file: {file_path}")
-                segmented_file_path = os.path.join(subdir, f"{file.replace('.nii.gz','')}_segmentation")
-                if not os.path.exists(segmented_file_path):
-                    os.makedirs(segmented_file_path)
-                
-                image = nib.load(file_path)
-                masks = totalsegmentator(image)
-                masks_without_header, labels = get_multilabel_nifti_header(masks)
-                flipped_labels = {v: k for k, v in labels.items()}
-                print(f"Labels: {flipped_labels}")
-                for bone in bones:
-                    mask = masks_without_header.get_fdata() == flipped_labels[bone]
-                    mask = mask.astype(int)
-                    mask = nib.Nifti1Image(mask, affine=None, header=masks_without_header.header)
-                    segmented_file_path_bone = os.path.join(segmented_file_path, f"{bone}.nii.gz")
-                    nib.save(mask, segmented_file_path_bone)
-                    print(f"Segmented file saved: {segmented_file_path_bone}")
-
-
-                # Save the segmented image
-                print(f"Segmented file saved: {segmented_file_path}")
+            if (file.endswith('.nii') or file.endswith('.nii.gz')) and 'CT' in file:
+                ct_paths.append(os.path.join(subdir, file))
+    return SegmentationWorker(backend).segment_files(ct_paths)
+
+# GPUs visible to TotalSegmentator when run as a script, None keeps CUDA_VISIBLE_DEVICES as it is
+cuda_devices = "1"
 
 if __name__ == "__main__":
     t_start = time.time()
     root_directory = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_quant"
-    segment_nifti_files(root_directory)
+    catalog = open_catalog(root_directory)
+    def register(ct_path, segmentation_dir):
+        catalog.add_artifacts(os.path.dirname(ct_path), 'bone_mask', [stored_path(os.path.join(segmentation_dir, f"{bone}.nii.gz"), MASK_FORMAT) for bone in bones],
+                              source=ct_path, bones=bones)
+    worker = SegmentationWorker(get_backend("totalsegmentator", bones, cuda_devices=cuda_devices))
+    worker.segment_files(catalog.series(modality='CT'), register)
     t_end = time.time()
     print("Total time: ", t_end-t_start)
\ No newline at end of file
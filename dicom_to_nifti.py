@@ -1,68 +1,230 @@
 import os
-import subprocess
+import json
 import shutil
+import hashlib
+import tempfile
+import contextlib
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import pydicom as dcm
 import SimpleITK as sitk
-import sys
+from study_catalog import open_catalog
 
-longlist = []
-converted_series = []
+longlist = set()
+converted_series = set()
 save_name = ""
 beta = 0
-dicom_path = ""
 
-def convert_dicom_to_nifti(input_dir, output_dir, save_name, beta):
-    # Create the output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+# Header fields needed to group and name the series
+INDEX_KEYS = ['SeriesInstanceUID', 'Modality', 'StudyID', 'StudyInstanceUID']
+MODALITY_PREFIXES = {"CT": "CT", "PT": "PT", "MR": "MR", "NM": "PT"}
+
+# Loads a previously saved header index, keyed by file path
+def load_dicom_index(index_path):
+    if index_path is None or not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+def save_dicom_index(index, index_path):
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
 
-    # Recursively search for DICOM files in the input directory
+# Reads the header of every .dcm file once (without pixel data) and groups the files by series
+# Files whose size and modification time match the saved index are not parsed again
+# Returns a dict of SeriesInstanceUID -> {'Modality', 'StudyID', 'root', 'files'} in walk order
+# 'StudyID' names the output directory of the study, it is the StudyInstanceUID when the StudyID tag is blank or missing
+def index_dicom_series(input_dir, index_path=None):
+    old_index = load_dicom_index(index_path)
+    index = {}
+    series = {}
     for root, dirs, files in os.walk(input_dir):
+        for file in sorted(files):
+            if not file.endswith('.dcm'):
+                continue
+            file_path = os.path.join(root, file)
+            stat = os.stat(file_path)
+            entry = old_index.get(file_path)
+            if (entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime
+                    or any(key not in entry for key in INDEX_KEYS)):
+                header = dcm.dcmread(file_path, stop_before_pixels=True, specific_tags=INDEX_KEYS)
+                entry = {key: str(getattr(header, key, "")) for key in INDEX_KEYS}
+                entry['size'] = stat.st_size
+                entry['mtime'] = stat.st_mtime
+            index[file_path] = entry
+
+            if entry['SeriesInstanceUID'] not in series:
+                series[entry['SeriesInstanceUID']] = {
+                    'Modality': entry['Modality'],
+                    'StudyID': entry['StudyID'].strip() or entry['StudyInstanceUID'].strip(),
+                    'root': root,
+                    'files': [],
+                }
+            series[entry['SeriesInstanceUID']]['files'].append(file_path)
+    if index_path is not None:
+        save_dicom_index(index, index_path)
+    return series
+
+# Stages the files of a series as the reference directory used downstream (e.g. by RTStructBuilder)
+# 'hardlink' and 'symlink' link each file into staging_dir, falling back to a copy when the filesystem can't link,
+# 'manifest' only writes staging_dir + '.json' listing the file paths, and 'copy' copies the files
+def stage_dicom_series(files, staging_dir, mode='hardlink'):
+    if mode == 'manifest':
+        with open(staging_dir + '.json', 'w') as f:
+            json.dump({'files': [os.path.abspath(file) for file in files]}, f)
+        return staging_dir + '.json'
+
+    os.makedirs(staging_dir, exist_ok=True)
+    for file in files:
+        destination = os.path.join(staging_dir, os.path.basename(file))
+        if os.path.exists(destination):
+            continue
+        try:
+            if mode == 'hardlink':
+                os.link(file, destination)
+            elif mode == 'symlink':
+                os.symlink(os.path.abspath(file), destination)
+            else:
+                shutil.copy2(file, destination)
+        except OSError:
+            shutil.copy2(file, destination)
+    return staging_dir
+
+# Context manager giving a directory holding the reference series staged at staging_dir, e.g.
+#   with resolve_dicom_series(staging_dir) as series_dir: ...
+# Manifests are materialised as a temporary directory of symlinks, removed when the block exits
+@contextlib.contextmanager
+def resolve_dicom_series(staging_dir):
+    if staging_dir.endswith('.json'):
+        staging_dir = staging_dir[:-len('.json')]
+    if os.path.isdir(staging_dir):
+        yield staging_dir
+        return
+    with open(staging_dir + '.json') as f:
+        files = json.load(f)['files']
+    resolved_dir = tempfile.mkdtemp(prefix=os.path.basename(staging_dir) + '_')
+    try:
         for file in files:
-            if file.endswith('.dcm') and dcm.dcmread(os.path.join(root, file)).SeriesInstanceUID not in converted_series and dcm.dcmread(os.path.join(root, file)).Modality != "RTSTRUCT":
-
-                dicom_path = os.path.join(root, file)
-                print(dicom_path)
-                # Convert DICOM to NIfTI using dcm2niix
-                nifti_filename = file.replace('.dcm', '.nii.gz')
-                nifti_path = os.path.join(output_dir, nifti_filename)
-                series_id = sitk.ImageSeriesReader_GetGDCMSeriesFileNames(os.path.abspath(dicom_path))
-                        #print(series_id)
-                series_reader = sitk.ImageSeriesReader()
-                series_reader.SetFileNames(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(os.path.abspath(root)))
-                print(series_reader.GetGDCMSeriesIDs(os.path.abspath(root)))
-                image = series_reader.Execute()
-                if dcm.dcmread(dicom_path).Modality == "CT":
-                    save_name = f"CT_{beta}.nii.gz"
-                    beta += 1
-                elif dcm.dcmread(dicom_path).Modality == "PT":
-                    save_name = f"PT_{beta}.nii.gz"
-                    beta += 1
-                elif dcm.dcmread(dicom_path).Modality == "MR":
-                    save_name = f"MR_{beta}.nii.gz"
-                    beta += 1
-                elif dcm.dcmread(dicom_path).Modality == "NM":
-                    save_name = f"PT_{beta}.nii.gz"
-                    beta += 1
-                
-                if dcm.dcmread(dicom_path).StudyID not in longlist:
-                    os.makedirs(os.path.join(output_dir, dcm.dcmread(dicom_path).StudyID), exist_ok=True)                
-                
-                output_path = os.path.join(output_dir, dcm.dcmread(dicom_path).StudyID, save_name)
-                sitk.WriteImage(image, output_path)
-                print(f"Converted {dicom_path} to {output_path}")
-                longlist.append(dcm.dcmread(dicom_path).StudyID)
-                if not os.path.exists(os.path.join(output_dir, dcm.dcmread(dicom_path).StudyID, save_name.replace('.nii.gz', '_DICOM'))):    
-                    shutil.copytree(root, os.path.join(output_dir, dcm.dcmread(dicom_path).StudyID, save_name.replace('.nii.gz', '_DICOM')))
-                                # with open("outputlist.txt", "a
-                #subprocess.run(['dcm2niix', '-z', 'y', '-o', output_dir, dicom_path])
-                converted_series.append(dcm.dcmread(os.path.join(root, file)).SeriesInstanceUID)
-
-                # Move the converted NIfTI file to the corresponding directory in the output directory
-                # output_subdir = os.path.relpath(root, input_dir)
-                # output_subdir_path = os.path.join(output_dir, output_subdir)
-                # os.makedirs(output_subdir_path, exist_ok=True)
-                #shutil.move(nifti_path, os.path.join(output_subdir_path, nifti_filename))
+            os.symlink(file, os.path.join(resolved_dir, os.path.basename(file)))
+        yield resolved_dir
+    finally:
+        shutil.rmtree(resolved_dir)
+
+# Reads one series with SimpleITK and writes it as <StudyID>/<save_name>, staging the DICOM files alongside
+# read_semaphore, when given, limits how many series are read from the filesystem at the same time
+def convert_series(series_uid, info, output_dir, save_name, read_semaphore=None, staging='hardlink'):
+    study_id = info['StudyID']
+    if not study_id:
+        raise ValueError(f"Series {series_uid} has neither a StudyID nor a StudyInstanceUID")
+    os.makedirs(os.path.join(output_dir, study_id), exist_ok=True)
+    series_reader = sitk.ImageSeriesReader()
+    series_reader.SetFileNames(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(os.path.abspath(info['root']), series_uid))
+    if read_semaphore is not None:
+        with read_semaphore:
+            image = series_reader.Execute()
+    else:
+        image = series_reader.Execute()
+
+    output_path = os.path.join(output_dir, study_id, save_name)
+    sitk.WriteImage(image, output_path)
+    staging_dir = os.path.join(output_dir, study_id, save_name.replace('.nii.gz', '_DICOM'))
+    if not os.path.exists(staging_dir) and not os.path.exists(staging_dir + '.json'):
+        stage_dicom_series(info['files'], staging_dir, staging)
+    return output_path
+
+# Registers a converted series and its staged DICOM reference in the study catalog
+def register_series(catalog, output_path, series_uid, modality, staging):
+    staging_dir = output_path.replace('.nii.gz', '_DICOM')
+    catalog.add_series(os.path.dirname(output_path), MODALITY_PREFIXES[modality], output_path, series_uid,
+                       staging_dir + '.json' if staging == 'manifest' else staging_dir)
+
+# Output name that only depends on the series, so parallel conversions never collide and re-runs are stable
+def series_save_name(series_uid, modality):
+    return f"{MODALITY_PREFIXES[modality]}_{hashlib.sha1(series_uid.encode()).hexdigest()[:12]}.nii.gz"
+
+_read_semaphore = None
+
+def _init_conversion_worker(read_semaphore):
+    global _read_semaphore
+    _read_semaphore = read_semaphore
+    # Parallelism comes from the process pool, each worker keeps SimpleITK single threaded
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+
+def _convert_series_task(series_uid, info, output_dir, save_name, staging):
+    return convert_series(series_uid, info, output_dir, save_name, _read_semaphore, staging)
+
+# Converts every series in a process pool, naming the outputs from the series UID instead of the walk order
+# At most max_concurrent_reads SimpleITK series reads run at once, to keep the filesystem from thrashing
+# Returns a dict of SeriesInstanceUID -> output path, and a dict of SeriesInstanceUID -> traceback for failed series
+# Converted series are registered in catalog when one is given
+def convert_dicom_to_nifti_parallel(input_dir, output_dir, n_workers=None, max_concurrent_reads=4, index_path=None, staging='hardlink',
+                                    catalog=None):
+    os.makedirs(output_dir, exist_ok=True)
+    if index_path is None:
+        index_path = os.path.join(output_dir, 'dicom_index.json')
+    series = index_dicom_series(input_dir, index_path)
+
+    read_semaphore = multiprocessing.BoundedSemaphore(max_concurrent_reads)
+    converted, errors = {}, {}
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_conversion_worker, initargs=(read_semaphore,)) as executor:
+        futures = {}
+        for series_uid, info in series.items():
+            if info['Modality'] not in MODALITY_PREFIXES:
+                continue
+            save_name = series_save_name(series_uid, info['Modality'])
+            futures[series_uid] = executor.submit(_convert_series_task, series_uid, info, output_dir, save_name, staging)
+        for series_uid, future in futures.items():
+            try:
+                converted[series_uid] = future.result()
+                print(f"Converted {series_uid} to {converted[series_uid]}")
+                if catalog is not None:
+                    register_series(catalog, converted[series_uid], series_uid, series[series_uid]['Modality'], staging)
+            except Exception:
+                errors[series_uid] = traceback.format_exc()
+                print(f"Failed to convert {series_uid}\n{errors[series_uid]}")
+    return converted, errors
+
+def convert_dicom_to_nifti(input_dir, output_dir, save_name, beta, index_path=None, staging='hardlink', catalog=None):
+    # Create the output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+    if index_path is None:
+        index_path = os.path.join(output_dir, 'dicom_index.json')
+
+    # Recursively search for DICOM files in the input directory, reading each header once
+    series = index_dicom_series(input_dir, index_path)
+    for series_uid, info in series.items():
+        if series_uid in converted_series or info['Modality'] == "RTSTRUCT":
+            continue
+        if info['Modality'] not in MODALITY_PREFIXES:
+            print(f"Skipping series {series_uid} with unsupported modality {info['Modality']}")
+            continue
+
+        dicom_path = info['files'][0]
+        print(dicom_path)
+        save_name = f"{MODALITY_PREFIXES[info['Modality']]}_{beta}.nii.gz"
+        beta += 1
+        output_path = convert_series(series_uid, info, output_dir, save_name, staging=staging)
+        print(f"Converted {dicom_path} to {output_path}")
+        if catalog is not None:
+            register_series(catalog, output_path, series_uid, info['Modality'], staging)
+        longlist.add(info['StudyID'])
+        converted_series.add(series_uid)
 
 input_dir = '/radraid/apps/personal/tfrigerio/data_dir/lunar_quant/lunar_quant_dicom'
 output_dir = '/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_quant'
-convert_dicom_to_nifti(input_dir, output_dir, save_name, beta)
\ No newline at end of file
+parallel = False
+n_workers = 8
+max_concurrent_reads = 4
+# How the reference DICOM series are staged next to the NIfTI files: 'hardlink', 'symlink', 'manifest' or 'copy'
+dicom_staging = 'hardlink'
+
+if __name__ == "__main__":
+    os.makedirs(output_dir, exist_ok=True)
+    catalog = open_catalog(output_dir)
+    if parallel:
+        convert_dicom_to_nifti_parallel(input_dir, output_dir, n_workers, max_concurrent_reads, staging=dicom_staging, catalog=catalog)
+    else:
+        convert_dicom_to_nifti(input_dir, output_dir, save_name, beta, staging=dicom_staging, catalog=catalog)
@@ -0,0 +1,148 @@
+import os
+import time
+import numpy as np
+import nibabel as nib
+from utility_functions import load_native_array, segment_all_bone_marrow
+from spect_resizing import resample_to_reference
+from snr_metastasis import SNR_THRESHOLD
+from thresholding_morphology import THRESHOLDING_PARAMS
+from nifti_to_rtstruct import mask_to_rtstruct
+from study_catalog import open_catalog
+from instrumentation import span, tags, enable, write_chrome_trace
+from volume_storage import save_mask, save_volume, save_label_map, mask_image, strip_extension
+
+# Intermediates that can be written by the in-memory mode, under the names used by the stage by stage pipeline
+# 'marrow_labels' is the marrow of every bone as one label map (see exclude_metastasis_label_map)
+INTERMEDIATES = ['bone_mask', 'resized', 'metastasis_snr', 'dynamic_average', 'marrow', 'marrow_labels', 'assembled_marrow']
+PER_BONE_INTERMEDIATES = ['bone_mask', 'dynamic_average', 'marrow']
+FULL_GRID = (slice(None), slice(None), slice(None))
+
+# Writes a mask computed inside bbox on the full grid with the CT geometry, bbox None writes an empty mask
+# The file is written in the intermediate mask format, assembled_marrow.nii.gz (a final output) as standard NIfTI
+def _save_mask(mask, bbox, shape, ct_image, output_path):
+    full_mask = np.zeros(shape, dtype=bool)
+    if bbox is not None:
+        full_mask[bbox] = mask
+    image = mask_image(full_mask, ct_image.affine, ct_image.header)
+    if os.path.basename(output_path) == 'assembled_marrow.nii.gz':
+        nib.save(image, output_path)
+        return output_path
+    return save_mask(image, output_path)
+
+# Runs every stage after the conversion for one study in a single process, keeping the CT, the label map,
+# the resampled SPECT and all masks in memory: only the RTSTRUCT is written, plus the intermediates listed in
+# save_intermediates (see INTERMEDIATES) at the paths the stage by stage pipeline would give them.
+# The thresholds of all bones come from one pass over the label map and each bone is processed inside its padded
+# bounding box (see segment_all_bone_marrow).
+# backend is the segmentation backend (see segmentation_backends.py), TotalSegmentator restricted to the bones by default
+# Returns the path of the RTSTRUCT (rt_utils adds the .dcm extension) and a dict of kind -> paths of the saved intermediates
+def process_study_in_memory(ct_path, pt_path, dicom_series_path, save_intermediates=(), params=THRESHOLDING_PARAMS, backend=None):
+    from bone_seg import load_label_array, bones
+    from segmentation_backends import get_backend
+
+    study_dir = os.path.dirname(ct_path)
+    marrow_dir = os.path.join(study_dir, 'marrow_segmentation')
+    segmentation_dir = ct_path.replace('.nii.gz', '_segmentation')
+    intermediate_dir = ct_path.replace('.nii.gz', '_intermediate')
+    saved = {kind: [] for kind in save_intermediates}
+    for kind, directory in [('bone_mask', segmentation_dir), ('dynamic_average', intermediate_dir), ('marrow', marrow_dir),
+                            ('marrow_labels', marrow_dir), ('assembled_marrow', marrow_dir)]:
+        if kind in saved:
+            os.makedirs(directory, exist_ok=True)
+    os.makedirs(marrow_dir, exist_ok=True)
+
+    with span('segment_bones'):
+        ct_image, ct_array = load_native_array(ct_path)
+        if ct_array.ndim == 4 and ct_array.shape[-1] == 1:
+            ct_array = ct_array[:, :, :, 0]
+        shape = ct_array.shape
+        if backend is None:
+            backend = get_backend('totalsegmentator', bones)
+        masks, labels = backend.segment(ct_image)
+        label_array = load_label_array(masks)
+        flipped_labels = {v: k for k, v in labels.items()}
+
+    with span('resample_and_detect_metastasis'):
+        spect_image = nib.load(pt_path)
+        spect_array = spect_image.get_fdata()
+        if spect_array.ndim == 4 and spect_array.shape[3] == 1:
+            spect_array = spect_array[:, :, :, 0]
+        resampled = resample_to_reference(spect_array, spect_image.affine, shape, ct_image.affine)
+        if resampled.ndim == 4:
+            raise ValueError(f"Dynamic SPECT is not supported by the in-memory mode: {pt_path}")
+        metastasis = resampled / np.std(resampled) >= SNR_THRESHOLD
+        del spect_array
+        if 'resized' in saved:
+            saved['resized'].append(save_volume(nib.Nifti1Image(resampled, ct_image.affine), pt_path.replace('.nii.gz', '_resized.nii.gz')))
+        if 'metastasis_snr' in saved:
+            saved['metastasis_snr'].append(_save_mask(metastasis, FULL_GRID, shape, ct_image,
+                                                      pt_path.replace('.nii.gz', '_metastasis_snr.nii.gz')))
+        del resampled
+
+    with span('threshold_and_exclude_metastasis'):
+        assembled = np.zeros(shape, dtype=bool)
+        marrow_labels = np.zeros(shape, dtype=np.uint8) if 'marrow_labels' in saved else None
+        bone_labels = [flipped_labels[bone] for bone in bones]
+        marrow_masks = segment_all_bone_marrow(ct_array, label_array, bone_labels, params['offset'], params['mode'], params['opening'],
+                                               erosion_iterations=params['erosion_iterations'])
+        for bone, (label, bbox, marrow) in zip(bones, marrow_masks):
+            if 'bone_mask' in saved:
+                bone_mask = label_array[bbox] == label if bbox is not None else None
+                saved['bone_mask'].append(_save_mask(bone_mask, bbox, shape, ct_image, os.path.join(segmentation_dir, f"{bone}.nii.gz")))
+            if 'dynamic_average' in saved:
+                saved['dynamic_average'].append(_save_mask(marrow, bbox, shape, ct_image,
+                                                           os.path.join(intermediate_dir, f"{bone}_dynamic_average.nii.gz")))
+            if bbox is not None:
+                marrow = marrow.astype(bool) & ~metastasis[bbox]
+            if 'marrow' in saved:
+                saved['marrow'].append(_save_mask(marrow, bbox, shape, ct_image, os.path.join(marrow_dir, f"{bone}_marrow.nii.gz")))
+            if bbox is not None and bone != 'spinal_cord':
+                assembled[bbox] |= marrow
+            if bbox is not None and marrow_labels is not None:
+                marrow_labels[bbox][marrow] = bones.index(bone) + 1
+
+    with span('export_rtstruct'):
+        if marrow_labels is not None:
+            saved['marrow_labels'].append(save_label_map(marrow_labels, dict(enumerate(bones, start=1)), ct_image.affine, ct_image.header,
+                                                         os.path.join(marrow_dir, 'marrow_labels.nii.gz')))
+        if 'assembled_marrow' in saved:
+            saved['assembled_marrow'].append(_save_mask(assembled, FULL_GRID, shape, ct_image,
+                                                        os.path.join(marrow_dir, 'assembled_marrow.nii.gz')))
+        rtstruct_output_path = os.path.join(marrow_dir, os.path.basename(study_dir))
+        mask_to_rtstruct(assembled, dicom_series_path, rtstruct_output_path, "BoneMarrow")
+    return rtstruct_output_path, saved
+
+root_dir = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_quant"
+# Intermediates to keep on disk besides the RTSTRUCT, e.g. ['assembled_marrow']
+save_intermediates = []
+# Directory of the trace of every step (see instrumentation.py), None to not trace
+trace_dir = None
+# GPUs visible to TotalSegmentator, None keeps CUDA_VISIBLE_DEVICES as it is
+cuda_devices = "1"
+
+if __name__ == "__main__":
+    t_start = time.time()
+    if trace_dir is not None:
+        enable(trace_dir)
+    from bone_seg import bones
+    from segmentation_backends import get_backend
+    backend = get_backend('totalsegmentator', bones, cuda_devices=cuda_devices)
+    catalog = open_catalog(root_dir)
+    for study_dir in catalog.studies():
+        ct_paths = catalog.series(study_dir, 'CT')
+        pt_paths = catalog.series(study_dir, 'PT')
+        if len(ct_paths) != 1 or not pt_paths:
+            print(f"Skipping {study_dir}: found {len(ct_paths)} CT and {len(pt_paths)} PT files")
+            continue
+        print(f"Processing study: {study_dir}")
+        with tags(study=os.path.basename(study_dir), series=os.path.basename(ct_paths[0])), span('in_memory'):
+            rtstruct_output_path, saved = process_study_in_memory(ct_paths[0], pt_paths[0], catalog.dicom_dir(ct_paths[0]),
+                                                                  save_intermediates, backend=backend)
+        for kind, paths in saved.items():
+            bones = [strip_extension(os.path.basename(p)).replace('_' + kind, '') for p in paths] if kind in PER_BONE_INTERMEDIATES else None
+            catalog.add_artifacts(study_dir, kind, paths, source=pt_paths[0] if kind == 'resized' else ct_paths[0], bones=bones)
+        catalog.add_artifacts(study_dir, 'rtstruct', [rtstruct_output_path + '.dcm'])
+    t_end = time.time()
+    print("Total time: ", t_end-t_start)
+    if trace_dir is not None:
+        write_chrome_trace(trace_dir, os.path.join(trace_dir, 'trace.json'))
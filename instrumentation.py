@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import resource
+import threading
+import contextvars
+
+# Spans of the stages and steps of the pipeline, disabled unless enable() is called (or the TRACE_ENV variable is set)
+# Each span records, with the tags (study, series, bone, ...) of the enclosing tags() blocks:
+#   wall_s                   wall time
+#   process_cpu_s            CPU time of the whole process while it ran, background threads (e.g. read_ahead, WriteBehind) included
+#   thread_cpu_s             CPU time of the thread running the span only
+#   rss_bytes                resident memory of the process when the span ends
+#   rss_delta_bytes          change of the resident memory over the span (what the step kept allocated)
+#   process_peak_rss_bytes   high-water mark of the process so far, not of the span: it stays the same after the peak
+#   read_bytes, written_bytes  bytes the process read and wrote while it ran
+# The process-wide values include whatever other threads of the process did at the same time.
+# Every process appends its spans to its own trace_<pid>.jsonl in the trace directory, processes started after
+# enable() (e.g. the pipeline workers) inherit it through TRACE_ENV. write_chrome_trace merges them for chrome://tracing.
+# When disabled, span() and tags() return a shared object that does nothing.
+
+TRACE_ENV = 'BONE_MARROW_TRACE_DIR'
+# ru_maxrss is in kilobytes on Linux
+RSS_UNIT = 1024
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_trace_dir = None
+_trace_file = None
+_trace_pid = None
+_lock = threading.Lock()
+_tags = contextvars.ContextVar('tags', default={})
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+# Bytes read and written by the process so far (Linux only, zeros elsewhere)
+def io_bytes():
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            counters = dict(line.split(b': ') for line in f.read().splitlines())
+        return int(counters[b'rchar']), int(counters[b'wchar'])
+    except OSError:
+        return 0, 0
+
+# Resident memory of the process (Linux only, 0 elsewhere)
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return 0
+
+def enable(trace_dir):
+    global _trace_dir
+    os.makedirs(trace_dir, exist_ok=True)
+    _trace_dir = os.path.abspath(trace_dir)
+    os.environ[TRACE_ENV] = _trace_dir
+
+def disable():
+    global _trace_dir, _trace_file
+    with _lock:
+        if _trace_file is not None and _trace_pid == os.getpid():
+            _trace_file.close()
+        _trace_dir = None
+        _trace_file = None
+    os.environ.pop(TRACE_ENV, None)
+
+def is_enabled():
+    return _trace_dir is not None
+
+# Appends a span to the trace file of this process, opened on first use (and again in a forked child)
+def _write(record):
+    global _trace_file, _trace_pid
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        if _trace_dir is None:
+            return
+        if _trace_file is None or _trace_pid != os.getpid():
+            _trace_pid = os.getpid()
+            _trace_file = open(os.path.join(_trace_dir, f'trace_{_trace_pid}.jsonl'), 'a')
+        _trace_file.write(line)
+        _trace_file.flush()
+
+class Span:
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = time.time()
+        self.wall_start = time.perf_counter()
+        self.process_cpu_start = time.process_time()
+        self.thread_cpu_start = time.thread_time()
+        self.rss_start = _rss_bytes()
+        self.read_start, self.written_start = io_bytes()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_s = time.perf_counter() - self.wall_start
+        process_cpu_s = time.process_time() - self.process_cpu_start
+        thread_cpu_s = time.thread_time() - self.thread_cpu_start
+        rss_end = _rss_bytes()
+        read_end, written_end = io_bytes()
+        _write({
+            'name': self.name,
+            'tags': {**_tags.get(), **self.tags},
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'start': self.start,
+            'wall_s': wall_s,
+            'process_cpu_s': process_cpu_s,
+            'thread_cpu_s': thread_cpu_s,
+            'rss_bytes': rss_end,
+            'rss_delta_bytes': rss_end - self.rss_start,
+            'process_peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT,
+            'read_bytes': read_end - self.read_start,
+            'written_bytes': written_end - self.written_start,
+            'error': exc_type.__name__ if exc_type is not None else None,
+        })
+        return False
+
+# Times the block as a span called name, with tags added to the ones of the enclosing tags() blocks
+def span(name, **tags):
+    if _trace_dir is None:
+        return _NULL_SPAN
+    return Span(name, tags)
+
+class _Tags:
+    def __init__(self, tags):
+        self.tags = tags
+
+    def __enter__(self):
+        self.token = _tags.set({**_tags.get(), **self.tags})
+        return self
+
+    def __exit__(self, *exc_info):
+        _tags.reset(self.token)
+        return False
+
+# Tags every span started in the block (in this thread), e.g. with tags(study=study_dir, bone=bone)
+def tags(**tags):
+    if _trace_dir is None:
+        return _NULL_SPAN
+    return _Tags(tags)
+
+# Spans of every process written to trace_dir, sorted by start time
+def read_trace(trace_dir):
+    records = []
+    for file in sorted(os.listdir(trace_dir)):
+        if file.startswith('trace_') and file.endswith('.jsonl'):
+            with open(os.path.join(trace_dir, file)) as f:
+                records += [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record['start'])
+
+# Writes the spans of trace_dir as complete events of the Chrome trace format (chrome://tracing, Perfetto)
+def write_chrome_trace(trace_dir, output_path):
+    events = []
+    for record in read_trace(trace_dir):
+        args = dict(record['tags'])
+        args.update({key: record[key] for key in ('process_cpu_s', 'thread_cpu_s', 'rss_bytes', 'rss_delta_bytes', 'process_peak_rss_bytes',
+                                                  'read_bytes', 'written_bytes', 'error')})
+        events.append({'name': record['name'], 'cat': record['tags'].get('stage', 'step'), 'ph': 'X',
+                       'ts': record['start'] * 1e6, 'dur': record['wall_s'] * 1e6,
+                       'pid': record['pid'], 'tid': record['tid'], 'args': args})
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return output_path
+
+# Processes started with TRACE_ENV set (e.g. pool workers of a traced run) trace to the same directory
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
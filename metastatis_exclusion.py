@@ -1,33 +1,128 @@
 import numpy as np
 import os 
 import nibabel as nib
+from result_cache import ResultCache
+from study_catalog import open_catalog
+from scipy.ndimage import find_objects, label
+from instrumentation import span
+from volume_storage import (MASK_FORMAT, VOLUME_FORMAT, READ_AHEAD, WRITE_BEHIND, load_mask, save_mask, mask_image, is_stored_volume,
+                            is_label_map, stored_path, load_label_map, save_label_map, read_ahead, WriteBehind)
 
-def subtract_metastasis(bone_image, metastasis_image):
-    bone_array = bone_image.get_fdata()
-    metastasis_array = metastasis_image.get_fdata()
+# Bounding boxes of the lesions of a metastasis mask (the boolean array of load_mask), found once per study
+def metastasis_regions(metastasis_array):
     if len(metastasis_array.shape) == 4:
         metastasis_array = metastasis_array[:, :, :, 0]
-    bone_array[metastasis_array == 1] = 0
-    bone_image = nib.Nifti1Image(bone_array, affine=bone_image.affine, header=bone_image.header)
+    lesions, _ = label(metastasis_array)
+    return find_objects(lesions)
+
+# Removes the metastasis voxels from a bone mask, both given as (image, boolean array) pairs from load_mask
+# Only the boxes of the lesions (regions, from metastasis_regions when not given) are touched, and the fresh array of
+# load_mask is masked in place instead of copied
+def subtract_metastasis(bone_image, metastasis_image, regions=None):
+    bone_image, bone_array = bone_image
+    _, metastasis_array = metastasis_image
+    if len(metastasis_array.shape) == 4:
+        metastasis_array = metastasis_array[:, :, :, 0]
+    if regions is None:
+        regions = metastasis_regions(metastasis_array)
+    if bone_array.dtype != bool or not bone_array.flags.writeable:
+        bone_array = np.array(bone_array, dtype=bool)
+    for bbox in regions:
+        bone_array[bbox] &= ~metastasis_array[bbox]
+    bone_image = mask_image(bone_array, affine=bone_image.affine, header=bone_image.header)
     return bone_image
 
+# Removes the metastasis voxels from the bone masks of one study, bone_paths[i] being saved to output_paths[i]
+# The metastasis mask is loaded once (as bool) and its lesions are found once for the whole study. The next bones are read and the masked ones written
+# in background threads while a bone is masked, max_workers (READ_AHEAD and WRITE_BEHIND by default) of each at most
+# With a result_cache, bones whose mask and metastasis mask are unchanged since their last run are skipped
+def exclude_metastasis_from_masks(bone_paths, metastasis_path, output_paths, result_cache=None, max_workers=None):
+    keys = {}
+    tasks = {}
+    for bone_path, output_path in zip(bone_paths, output_paths):
+        if result_cache is not None:
+            keys[output_path] = result_cache.key([bone_path, metastasis_path], {})
+            if result_cache.is_up_to_date(output_path, keys[output_path]):
+                continue
+        tasks[bone_path] = output_path
+    if not tasks:
+        return output_paths
+
+    def saved(output_path):
+        print(f"Saved file: {output_path}")
+        if result_cache is not None:
+            result_cache.record(output_path, keys[output_path])
+
+    with span('load_metastasis'):
+        metastasis_image = load_mask(metastasis_path)
+        regions = metastasis_regions(metastasis_image[1])
+    with WriteBehind(WRITE_BEHIND if max_workers is None else max_workers, done=saved) as writer:
+        for bone_path, bone_image in read_ahead(tasks, load_mask, READ_AHEAD if max_workers is None else max_workers):
+            with span('exclude_bone', bone=os.path.basename(bone_path)):
+                writer.submit(tasks[bone_path], save_mask, subtract_metastasis(bone_image, metastasis_image, regions), tasks[bone_path])
+    if result_cache is not None:
+        result_cache.save()
+    return output_paths
+
+# Removes the metastasis voxels from every *dynamic_average* bone mask of intermediate_dir,
+# saving the results as *marrow* masks in output_dir
+# With a result_cache, bones whose mask and metastasis mask are unchanged since their last run are skipped
+def exclude_metastasis(intermediate_dir, metastasis_path, output_dir, result_cache=None, max_workers=None):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    files = [file for file in os.listdir(intermediate_dir) if is_stored_volume(file) and 'dynamic_average' in file and not is_label_map(file)]
+    output_paths = [stored_path(os.path.join(output_dir, file.replace('dynamic_average', 'marrow')), MASK_FORMAT) for file in files]
+    return exclude_metastasis_from_masks([os.path.join(intermediate_dir, file) for file in files], metastasis_path, output_paths,
+                                         result_cache, max_workers)
+
+# Removes the metastasis voxels from the marrow label map of threshold_study_label_map in a single operation,
+# saving the result as output_dir/marrow_labels with the same table of names
+# With save_bone_masks, each bone is also written as a *_marrow mask, from the label map inside its bounding box
+# Returns the paths written, the label map first
+def exclude_metastasis_label_map(label_map_path, metastasis_path, output_dir, result_cache=None, save_bone_masks=False):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    image, label_map, names = load_label_map(label_map_path)
+    output_path = stored_path(os.path.join(output_dir, 'marrow_labels.nii.gz'), VOLUME_FORMAT)
+    bone_output_paths = {label: stored_path(os.path.join(output_dir, f"{name}_marrow.nii.gz"), MASK_FORMAT) for label, name in names.items()}
+    output_paths = [output_path] + (list(bone_output_paths.values()) if save_bone_masks else [])
+    if result_cache is not None:
+        key = result_cache.key([label_map_path, metastasis_path], {'save_bone_masks': save_bone_masks})
+        if all(result_cache.is_up_to_date(path, key) for path in output_paths):
+            return output_paths
+
+    _, metastasis_array = load_mask(metastasis_path)
+    if len(metastasis_array.shape) == 4:
+        metastasis_array = metastasis_array[:, :, :, 0]
+    label_map = np.where(metastasis_array, np.uint8(0), label_map)
+    save_label_map(label_map, names, image.affine, image.header, output_path)
+    if save_bone_masks:
+        bboxes = find_objects(label_map, max_label=max(names))
+        for label, bone_output_path in bone_output_paths.items():
+            mask = np.zeros(label_map.shape, dtype=bool)
+            if bboxes[label - 1] is not None:
+                mask[bboxes[label - 1]] = label_map[bboxes[label - 1]] == label
+            save_mask(mask_image(mask, image.affine, image.header), bone_output_path)
+    if result_cache is not None:
+        for path in output_paths:
+            result_cache.record(path, key)
+        result_cache.save()
+    return output_paths
+
 root_dir = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_quant"
+max_workers = 8
 
 if __name__ == "__main__":
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith('.nii.gz') and '_intermediate' in subdir and 'dynamic_average' in file:
-
-                previous_dir = subdir.split('/CT_')[0]
-                output_dir = os.path.join(previous_dir, 'marrow_segmentation')
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
-                
-                for metastasis_file in os.listdir(previous_dir):
-                    if 'metastasis_snr' in metastasis_file:
-                        metastasis_image = nib.load(os.path.join(previous_dir, metastasis_file))
-                        bone_image = nib.load(os.path.join(subdir, file))
-                        bone_image = subtract_metastasis(bone_image, metastasis_image)
-                        output_path = os.path.join(output_dir, file.replace('dynamic_average', 'marrow'))
-                        nib.save(bone_image, output_path)
-                        print(f"Saved file: {output_path}")
+    catalog = open_catalog(root_dir)
+    for previous_dir in catalog.studies():
+        output_dir = os.path.join(previous_dir, 'marrow_segmentation')
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        for metastasis_path in catalog.artifacts('metastasis_snr', previous_dir):
+            bone_paths = catalog.artifacts('dynamic_average', previous_dir)
+            output_paths = [stored_path(os.path.join(output_dir, os.path.basename(bone_path).replace('dynamic_average', 'marrow')), MASK_FORMAT)
+                            for bone_path in bone_paths]
+            exclude_metastasis_from_masks(bone_paths, metastasis_path, output_paths, max_workers=max_workers)
+            for bone_path, output_path in zip(bone_paths, output_paths):
+                catalog.add_artifacts(previous_dir, 'marrow', [output_path], source=bone_path, bones=[catalog.bone(bone_path)])
@@ -1,96 +1,283 @@
 import numpy as np
 import os 
+import itertools
+import importlib.metadata
 import nibabel as nib
-import SimpleITK as sitk
-from rt_utils import RTStructBuilder
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import find_objects
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
 import pydicom
 import time
-def nifti_to_rtstruct(nifti_path, dicom_series_path, output_path, roi_name="Segmentation"):
+from study_catalog import open_catalog
+from instrumentation import span
+from utility_functions import pad_bounding_box
+from volume_storage import load_mask, mask_image, is_stored_volume, is_label_map, load_label_map, strip_extension, read_ahead
+
+# Processes computing the contours (1 computes them in the calling process)
+CONTOUR_WORKERS = 8
+# Axial slices per contouring task
+CONTOUR_SLICES = 16
+# Background kept around the cropped ROI in each slice, so its contours are those of the whole slice
+CONTOUR_MARGIN = 2
+# The pooled contouring of export_rois calls internal helpers of rt_utils (image_helper, ds_helper, ROIData), which
+# change between releases. It is only used with the releases it was checked against (same contours as RTStruct.add_roi),
+# other releases go through the public RTStruct.add_roi, one ROI at a time in the calling process
+POOLED_RT_UTILS_VERSIONS = ('1.2.7',)
+
+def _rt_utils_version():
+    try:
+        return importlib.metadata.version('rt-utils')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+POOLED_CONTOURS = _rt_utils_version() in POOLED_RT_UTILS_VERSIONS
 
+def nifti_to_rtstruct(nifti_path, dicom_series_path, output_path, roi_name="Segmentation"):
     # Load the NIFTI mask
-    nifti_mask = sitk.ReadImage(nifti_path)
-    mask_array = sitk.GetArrayFromImage(nifti_mask)
-    
-    # Load mask with nibabel
-    nifti_mask = nib.load(nifti_path)
-    mask_array = nifti_mask.get_fdata()
-    # Invert x and y axes
-    empty_array = np.zeros_like(mask_array)
-    for i in range(empty_array.shape[0]):
-        empty_array[i] = mask_array[:,i,:]
-    # Create RT Struct object
-    rtstruct = RTStructBuilder.create_new(dicom_series_path)
-    
-    # Add ROI from the binary mask
-    # Note: mask_array needs to be boolean
-    print(np.max(empty_array))
-    print(np.min(empty_array))
-    print(type(empty_array))
-    print(type(empty_array[0][0][0]))
-    empty_array = np.rint(empty_array)
-    mask_array = empty_array.astype(bool)
-    
-    # Add the ROI to the RTSTRUCT
-    rtstruct.add_roi(
-        mask=mask_array,
-        color=[255, 0, 0], 
-        name=roi_name
-    )
-    
-    # Save the RTSTRUCT file
-    rtstruct.save(output_path)
+    nifti_mask, mask_array = load_mask(nifti_path)
+    mask_to_rtstruct(mask_array, dicom_series_path, output_path, roi_name)
+
+# Mask on the NIfTI grid (x, y, z) as rt_utils expects it (rows, columns, slices): a view with x and y swapped, no copy
+def to_dicom_axes(mask_array):
+    if np.issubdtype(mask_array.dtype, np.floating):
+        mask_array = np.rint(mask_array)
+    if mask_array.dtype != bool:
+        mask_array = mask_array != 0
+    return np.transpose(mask_array, (1, 0, 2))
+
+# Contours of the slices of a cropped ROI, as rt_utils computes them in RTStruct.add_roi: per slice, a list of
+# contours given as flat lists of patient coordinates. offset is the (row, column, slice) of the crop in the series
+def _contour_slab(slab, offset, transformation_matrix, use_pin_hole=False, approximate_contours=True):
+    from rt_utils import image_helper
+    row_start, column_start, z_start = offset
+    slab_contours = []
+    for i in range(slab.shape[2]):
+        mask_slice = slab[:, :, i]
+        if not mask_slice.any():
+            slab_contours.append([])
+            continue
+        if use_pin_hole:
+            mask_slice = image_helper.create_pin_hole_mask(mask_slice, approximate_contours)
+        contours, _ = image_helper.find_mask_contours(mask_slice, approximate_contours)
+        image_helper.validate_contours(contours)
+        formatted_contours = []
+        for contour in contours:
+            # Contour points are (column, row) in the crop
+            contour = np.array(contour) + [column_start, row_start]
+            contour = np.concatenate((contour, np.full((len(contour), 1), z_start + i)), axis=1)
+            transformed_contour = image_helper.apply_transformation_to_3d_points(contour, transformation_matrix)
+            formatted_contours.append(np.ravel(transformed_contour).tolist())
+        slab_contours.append(formatted_contours)
+    return slab_contours
+
+# Padded bounding box of a mask in DICOM axes, None when the mask is empty
+def _roi_bbox(mask):
+    bbox = find_objects(mask.view(np.uint8))
+    if not bbox:
+        return None
+    return pad_bounding_box(bbox[0][:2], CONTOUR_MARGIN, mask.shape[:2]) + bbox[0][2:]
+
+# Splits a cropped ROI into tasks of CONTOUR_SLICES slices for _contour_slab
+def _slab_tasks(crop, bbox, transformation_matrix, use_pin_hole, approximate_contours):
+    for z in range(0, crop.shape[2], CONTOUR_SLICES):
+        offset = (bbox[0].start, bbox[1].start, bbox[2].start + z)
+        yield np.ascontiguousarray(crop[:, :, z:z + CONTOUR_SLICES]), offset, transformation_matrix, use_pin_hole, approximate_contours
+
+# Writes a new RTSTRUCT referencing the DICOM series with one ROI per entry of rois, an iterable of
+# (name, color, crop, bbox, shape): the ROI cropped to bbox of a volume of that shape in DICOM axes (see to_dicom_axes),
+# crop None for an empty ROI, color None for the rt_utils palette. The contours of every slice are computed in n_workers processes while the
+# ROIs are read, then added to the dataset in order (with POOLED_CONTOURS, otherwise each ROI goes through RTStruct.add_roi)
+def export_rois(rois, dicom_series_path, output_path, n_workers=CONTOUR_WORKERS, use_pin_hole=False, approximate_contours=True):
+    # rt_utils (and SimpleITK, through dicom_to_nifti) are only needed to write an RTSTRUCT, the assembly of the masks runs without them
+    from rt_utils import RTStruct, RTStructBuilder, ds_helper, image_helper
+    from rt_utils.utils import ROIData
+    from dicom_to_nifti import resolve_dicom_series
+    # The series is read into memory, a manifest's temporary directory can go right after
+    with span('load_dicom_series'), resolve_dicom_series(dicom_series_path) as series_dir:
+        rtstruct = RTStructBuilder.create_new(series_dir)
+    series_data = rtstruct.series_data
+    series_shape = (int(series_data[0].Rows), int(series_data[0].Columns), len(series_data))
+    transformation_matrix = image_helper.get_pixel_to_patient_transformation_matrix(series_data) if POOLED_CONTOURS else None
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers != 1 and POOLED_CONTOURS else None
+    try:
+        roi_contours = []
+        # The ROIs are read (and cropped) while the pool computes the contours of the ones before
+        with span('read_rois'):
+            for name, color, crop, bbox, shape in rois:
+                if tuple(shape) != series_shape:
+                    raise RTStruct.ROIException(f"ROI {name} has shape {tuple(shape)}, the DICOM series has shape {series_shape}")
+                if not POOLED_CONTOURS:
+                    mask = np.zeros(shape, dtype=bool)
+                    if crop is not None:
+                        mask[bbox] = crop
+                    rtstruct.add_roi(mask=mask, color=color, name=name, use_pin_hole=use_pin_hole, approximate_contours=approximate_contours)
+                    continue
+                tasks = [] if crop is None else _slab_tasks(crop, bbox, transformation_matrix, use_pin_hole, approximate_contours)
+                if executor is None:
+                    slabs = [_contour_slab(*task) for task in tasks]
+                else:
+                    slabs = [executor.submit(_contour_slab, *task) for task in tasks]
+                z_start = bbox[2].start if crop is not None else 0
+                roi_contours.append((name, color, z_start, slabs))
+
+        with span('assemble_contours'):
+            for name, color, z_start, slabs in roi_contours:
+                roi_data = ROIData(None, color, len(rtstruct.ds.StructureSetROISequence) + 1, name, rtstruct.frame_of_reference_uid)
+                contour_sequence = Sequence()
+                z = z_start
+                for slab in slabs:
+                    for slice_contours in (slab if executor is None else slab.result()):
+                        for contour_data in slice_contours:
+                            contour_sequence.append(ds_helper.create_contour(series_data[z], contour_data))
+                        z += 1
+                if not contour_sequence:
+                    print(f"[INFO]: ROI {name} is empty")
+                roi_contour = Dataset()
+                roi_contour.ROIDisplayColor = roi_data.color
+                roi_contour.ContourSequence = contour_sequence
+                roi_contour.ReferencedROINumber = str(roi_data.number)
+                rtstruct.ds.ROIContourSequence.append(roi_contour)
+                rtstruct.ds.StructureSetROISequence.append(ds_helper.create_structure_set_roi(roi_data))
+                rtstruct.ds.RTROIObservationsSequence.append(ds_helper.create_rtroi_observation(roi_data))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    with span('save'):
+        rtstruct.save(output_path)
+
+# ROIs (see export_rois) of masks on the NIfTI grid, given as (name, mask) or (name, mask, color) and read one at a time
+def mask_rois(masks):
+    for name, mask, *color in masks:
+        mask = to_dicom_axes(mask)
+        bbox = _roi_bbox(mask)
+        yield name, color[0] if color else None, mask[bbox] if bbox is not None else None, bbox, mask.shape
 
+# Exports masks on the NIfTI grid as ROIs of one new RTSTRUCT referencing the DICOM series (see mask_rois)
+def masks_to_rtstruct(masks, dicom_series_path, output_path, n_workers=CONTOUR_WORKERS):
+    export_rois(mask_rois(masks), dicom_series_path, output_path, n_workers)
+
+# Exports a mask array (on the NIfTI grid) as a single ROI of a new RTSTRUCT referencing the DICOM series
+def mask_to_rtstruct(mask_array, dicom_series_path, output_path, roi_name="Segmentation", n_workers=CONTOUR_WORKERS):
+    masks_to_rtstruct([(roi_name, mask_array, [255, 0, 0])], dicom_series_path, output_path, n_workers)
+
+# ROIs (see export_rois) of a label map (see save_label_map): one per label, or with groups (dict of ROI name -> names
+# of the labels it covers) one per group. Each ROI is cut from the label map inside its own bounding box
+def label_map_rois(label_map, names, groups=None, excluded=()):
+    label_map = np.transpose(label_map, (1, 0, 2))
+    label_bboxes = find_objects(label_map)
+    labels = {name: label for label, name in names.items()}
+    if groups is None:
+        groups = {name: [name] for name in names.values() if name not in excluded}
+    for group, members in groups.items():
+        group_labels = [labels[name] for name in members if name in labels and name not in excluded]
+        bboxes = [label_bboxes[label - 1] for label in group_labels if label <= len(label_bboxes) and label_bboxes[label - 1] is not None]
+        if not bboxes:
+            yield group, None, None, None, label_map.shape
+            continue
+        bbox = tuple(slice(min(b[axis].start for b in bboxes), max(b[axis].stop for b in bboxes)) for axis in range(3))
+        bbox = pad_bounding_box(bbox[:2], CONTOUR_MARGIN, label_map.shape[:2]) + bbox[2:]
+        yield group, None, np.isin(label_map[bbox], group_labels), bbox, label_map.shape
+
+# Exports a label map as one ROI per label (or per group of labels, see label_map_rois) of a new RTSTRUCT
+def label_map_to_rtstruct(label_map_path, dicom_series_path, output_path, groups=None, excluded=('spinal_cord',), n_workers=CONTOUR_WORKERS):
+    image, label_map, names = load_label_map(label_map_path)
+    export_rois(label_map_rois(label_map, names, groups, excluded), dicom_series_path, output_path, n_workers)
+
+# Sums the marrow masks of bone_dir (the spinal cord left out) into a uint8 count of the bones covering each voxel
 def combine_bone_marrow(bone_dir, output_path):
     counter = 0
-    for file in os.listdir(bone_dir):
-
-        if file.endswith('.nii.gz') and 'marrow' in file and 'spinal_cord' not in file and "assembled" not in file:
-            bone_image = nib.load(os.path.join(bone_dir, file))
-            if counter == 0:
-                marrow_array = bone_image.get_fdata()
-                counter += 1
-            else:
-                bone_array = bone_image.get_fdata()
-                marrow_array += bone_array
-    marrow_image = nib.Nifti1Image(marrow_array, affine=bone_image.affine, header=bone_image.header)
+    paths = [os.path.join(bone_dir, file) for file in os.listdir(bone_dir)
+             if is_stored_volume(file) and 'marrow' in file and 'spinal_cord' not in file and "assembled" not in file and not is_label_map(file)]
+    # The next masks are decompressed while the current one is added
+    for path, (bone_image, bone_array) in read_ahead(paths, load_mask):
+        if counter == 0:
+            marrow_array = bone_array.astype(np.uint8)
+            counter += 1
+        else:
+            marrow_array += bone_array
+    marrow_image = mask_image(marrow_array, affine=bone_image.affine, header=bone_image.header)
     nib.save(marrow_image, output_path)
     return marrow_array
 
+# Assembles a marrow label map (see exclude_metastasis_label_map) with one lookup: every label but the spinal cord is kept
+def combine_marrow_label_map(label_map_path, output_path, excluded=('spinal_cord',)):
+    image, label_map, names = load_label_map(label_map_path)
+    keep = np.zeros(256, dtype=bool)
+    keep[[label for label, name in names.items() if name not in excluded]] = True
+    marrow_array = keep[label_map]
+    nib.save(mask_image(marrow_array, affine=image.affine, header=image.header), output_path)
+    return marrow_array
+
+# Marrow masks of the bones in marrow_dir (one *_marrow file each) by bone name
+def _bone_marrow_paths(marrow_dir):
+    return {strip_extension(file)[:-len('_marrow')]: os.path.join(marrow_dir, file) for file in sorted(os.listdir(marrow_dir))
+            if is_stored_volume(file) and strip_extension(file).endswith('_marrow') and 'assembled' not in file}
+
+# Masks of the per-bone marrow files as (name, mask): one per bone, or with groups (dict of ROI name -> bone names) one per group
+def _bone_marrow_masks(marrow_dir, groups=None, excluded=('spinal_cord',)):
+    paths = _bone_marrow_paths(marrow_dir)
+    if groups is None:
+        groups = {bone: [bone] for bone in paths if bone not in excluded}
+    members = {group: [paths[bone] for bone in bones if bone in paths and bone not in excluded] for group, bones in groups.items()}
+    # The masks are read ahead in the order the groups use them, while the ROIs before them are contoured
+    masks = read_ahead(itertools.chain.from_iterable(members.values()), load_mask)
+    for group, group_paths in members.items():
+        mask = None
+        for _, (bone_image, bone_mask) in itertools.islice(masks, len(group_paths)):
+            mask = bone_mask if mask is None else mask | bone_mask
+        if mask is not None:
+            yield group, mask
+
+# Assembles the per-bone marrow masks of marrow_dir (or its marrow label map with label_map=True) and exports them
+# as an RTSTRUCT named after the study, referencing the CT DICOM series staged in the study directory
+# The RTSTRUCT holds the whole marrow as "BoneMarrow", and with bone_rois one more ROI per bone (or per group of
+# bones with roi_groups, a dict of ROI name -> bone names)
+def export_marrow_rtstruct(marrow_dir, label_map=False, bone_rois=False, roi_groups=None):
+    previous_dir = marrow_dir.split('/marrow_segmentation')[0]
+    studyid = previous_dir.split('/')[-1]
+    print(f"Study ID: {studyid}")
+    output_path = os.path.join(marrow_dir, "assembled_marrow.nii.gz")
+    label_map_path = os.path.join(marrow_dir, "marrow_labels.nii.gz")
+    with span('combine'):
+        if label_map:
+            marrow_array = combine_marrow_label_map(label_map_path, output_path)
+        else:
+            marrow_array = combine_bone_marrow(marrow_dir, output_path)
+    print(f"Saved assembled marrow to: {output_path}")
+    rtstruct_output_path = os.path.join(marrow_dir, studyid)
+    dicom_path_list = os.listdir(previous_dir)
+
+    for dicom_path in dicom_path_list:
+        if '_DICOM' in dicom_path and 'CT_' in dicom_path:
+            dicom_series_path = os.path.join(previous_dir, dicom_path)
+            print(f"Processing DICOM series: {dicom_series_path}")
+            break
+
+    rois = mask_rois([("BoneMarrow", marrow_array, [255, 0, 0])])
+    if bone_rois and label_map:
+        image, label_array, names = load_label_map(label_map_path)
+        rois = itertools.chain(rois, label_map_rois(label_array, names, roi_groups, excluded=('spinal_cord',)))
+    elif bone_rois:
+        rois = itertools.chain(rois, mask_rois(_bone_marrow_masks(marrow_dir, roi_groups)))
+    export_rois(rois, dicom_series_path, rtstruct_output_path)
+    return rtstruct_output_path
+
 root_dir = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_quant/"
+# One ROI per bone next to "BoneMarrow", or per group of bones, e.g. {'spine': ['vertebrae_L1', 'vertebrae_L2']}
+bone_rois = False
+roi_groups = None
 
 if __name__ == "__main__":
     t0 = time.time()
-    subdir_list = []
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if "marrow" in file and "spinal_cord" not in file and "marrow_segmentation" in subdir:
-                if subdir in subdir_list:
-                    continue
-                list_dir = os.listdir(subdir)
-                escape = False
-                for item in list_dir:
-                    if ".dcm" in item:
-                        escape =True
-                if escape:
-                    continue
-                print(f"Processing directory: {subdir}")
-                subdir_list.append(subdir)
-                previous_dir = subdir.split('/marrow_segmentation')[0]
-                studyid = subdir.split('/marrow_segmentation')[0].split('/')[-1]
-                print(f"Study ID: {studyid}")
-                output_path = os.path.join(subdir, "assembled_marrow.nii.gz")
-                marrow_array = combine_bone_marrow(subdir, output_path)
-                marrow_array = nib.load(output_path).get_fdata()
-                print(f"Saved assembled marrow to: {output_path}")
-                rtstruct_output_path = os.path.join(subdir, studyid)
-                dicom_path_list = os.listdir(previous_dir)
-                
-                for dicom_path in dicom_path_list:
-                    if '_DICOM' in dicom_path and 'CT_' in dicom_path:
-                        dicom_series_path = os.path.join(previous_dir, dicom_path)
-                        print(f"Processing DICOM series: {dicom_series_path}")
-                        break
-            
-                nifti_to_rtstruct(output_path, dicom_series_path, rtstruct_output_path, "BoneMarrow")
+    catalog = open_catalog(root_dir)
+    for study_dir in catalog.studies():
+        if not catalog.artifacts('marrow', study_dir) or catalog.artifacts('rtstruct', study_dir):
+            continue
+        subdir = os.path.join(study_dir, 'marrow_segmentation')
+        print(f"Processing directory: {subdir}")
+        rtstruct_output_path = export_marrow_rtstruct(subdir, bone_rois=bone_rois, roi_groups=roi_groups)
+        catalog.add_artifacts(study_dir, 'assembled_marrow', [os.path.join(subdir, "assembled_marrow.nii.gz")])
+        catalog.add_artifacts(study_dir, 'rtstruct', [rtstruct_output_path + '.dcm'])
     t1 = time.time()
-    print("time ",t1-t0)           
+    print("time ",t1-t0)
@@ -0,0 +1,354 @@
+import os
+import contextlib
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from result_cache import ResultCache
+from study_catalog import StudyCatalog, open_catalog, CATALOG_NAME
+from instrumentation import span, tags, enable, write_chrome_trace
+from volume_storage import MASK_FORMAT, VOLUME_FORMAT, is_stored_volume, is_label_map, stored_path, strip_extension
+
+# Derived NIfTI files living next to the converted series in a study directory
+DERIVED_MARKERS = ['resized', 'metastasis', 'assembled']
+
+# Catalog of the tree, or None to find the inputs by listing the study directory, closed at the end of the with block
+def _open_catalog(catalog_path):
+    return contextlib.nullcontext() if catalog_path is None else StudyCatalog(catalog_path)
+
+# Converted series of a study directory for one modality prefix ('CT' or 'PT'), derived files excluded
+def study_series(study_dir, modality, catalog=None):
+    if catalog is not None:
+        return catalog.series(study_dir, modality)
+    return sorted(
+        os.path.join(study_dir, file) for file in os.listdir(study_dir)
+        if file.startswith(modality + '_') and file.endswith('.nii.gz') and not any(m in file for m in DERIVED_MARKERS)
+    )
+
+# Calls compute() unless output_path is up to date with the input files and parameters in the stage's cache manifest
+def run_cached(study_dir, stage, input_paths, params, output_path, compute, use_cache=True):
+    if not use_cache:
+        compute()
+        return output_path
+    result_cache = ResultCache(study_dir, stage)
+    key = result_cache.key(input_paths, params)
+    if result_cache.is_up_to_date(output_path, key):
+        print(f"Up to date: {output_path}")
+        return output_path
+    compute()
+    result_cache.record(output_path, key)
+    result_cache.save()
+    return output_path
+
+# Each stage below processes one study directory (<output_dir>/<StudyID>)
+# Inputs are looked up in, and outputs registered to, the catalog at catalog_path when one is given
+
+def run_conversion(study_dir, series=(), staging='hardlink', use_cache=True, catalog_path=None):
+    from dicom_to_nifti import convert_series, series_save_name, register_series
+    with _open_catalog(catalog_path) as catalog:
+        output_paths = []
+        for series_uid, info in series:
+            save_name = series_save_name(series_uid, info['Modality'])
+            output_path = run_cached(study_dir, 'dicom_to_nifti', info['files'], {'staging': staging}, os.path.join(study_dir, save_name),
+                                     lambda: convert_series(series_uid, info, os.path.dirname(study_dir), save_name, staging=staging),
+                                     use_cache)
+            if catalog is not None:
+                register_series(catalog, output_path, series_uid, info['Modality'], staging)
+            output_paths.append(output_path)
+        return output_paths
+
+# Options of the segmentation backend, the GPUs (CUDA_VISIBLE_DEVICES, None keeps it as it is) only matter to TotalSegmentator
+def _backend_options(backend, cuda_devices):
+    return {'cuda_devices': cuda_devices} if backend == 'totalsegmentator' and cuda_devices is not None else {}
+
+# backend names the segmentation backend (see segmentation_backends.py), set up once per worker process and kept warm
+def run_segmentation(study_dir, backend='totalsegmentator', cuda_devices=None, use_cache=True, catalog_path=None):
+    from bone_seg import segment_ct_file, bones
+    from segmentation_backends import get_backend
+    with _open_catalog(catalog_path) as catalog:
+        output_paths = []
+        for ct_path in study_series(study_dir, 'CT', catalog):
+            segmentation_dir = run_cached(study_dir, 'bone_seg', [ct_path], {'bones': bones, 'backend': backend},
+                                          ct_path.replace('.nii.gz', '_segmentation'),
+                                          lambda: segment_ct_file(ct_path, backend=get_backend(backend, bones, **_backend_options(backend, cuda_devices))),
+                                          use_cache)
+            if catalog is not None:
+                catalog.add_artifacts(study_dir, 'bone_mask', [stored_path(os.path.join(segmentation_dir, f"{bone}.nii.gz"), MASK_FORMAT) for bone in bones],
+                                      source=ct_path, bones=bones)
+            output_paths.append(segmentation_dir)
+        return output_paths
+
+def run_resizing(study_dir, use_cache=True, catalog_path=None):
+    from spect_resizing import resize_spect_to_ct
+    with _open_catalog(catalog_path) as catalog:
+        ct_paths = study_series(study_dir, 'CT', catalog)
+        if len(ct_paths) != 1:
+            raise ValueError(f"Found {len(ct_paths)} CT files in {study_dir}")
+        output_paths = []
+        for pt_path in study_series(study_dir, 'PT', catalog):
+            resized_path = stored_path(pt_path.replace('.nii.gz', '_resized.nii.gz'), VOLUME_FORMAT)
+            output_path = run_cached(study_dir, 'spect_resizing', [pt_path, ct_paths[0]], {'interpolation_order': 1}, resized_path,
+                                     lambda: resize_spect_to_ct(pt_path, ct_paths[0], resized_path), use_cache)
+            if catalog is not None:
+                catalog.add_artifacts(study_dir, 'resized', [output_path], source=pt_path)
+            output_paths.append(output_path)
+        return output_paths
+
+def run_snr(study_dir, use_cache=True, catalog_path=None):
+    from snr_metastasis import metastasis_detector, SNR_THRESHOLD
+    with _open_catalog(catalog_path) as catalog:
+        if catalog is not None:
+            resized_paths = catalog.artifacts('resized', study_dir)
+        else:
+            resized_paths = [stored_path(pt_path.replace('.nii.gz', '_resized.nii.gz'), VOLUME_FORMAT) for pt_path in study_series(study_dir, 'PT')]
+        output_paths = []
+        for resized_path in resized_paths:
+            output_path = run_cached(study_dir, 'snr_metastasis', [resized_path], {'snr_threshold': SNR_THRESHOLD},
+                                     stored_path(strip_extension(resized_path)[:-len('resized')] + 'metastasis_snr.nii.gz', MASK_FORMAT),
+                                     lambda: metastasis_detector(resized_path)(resized_path), use_cache)
+            if catalog is not None:
+                catalog.add_artifacts(study_dir, 'metastasis_snr', [output_path], source=resized_path)
+            output_paths.append(output_path)
+        return output_paths
+
+# With label_map, the thresholding, exclusion and export stages work on one marrow label map per study
+# instead of one mask per bone (see threshold_study_label_map)
+def run_thresholding(study_dir, label_map=False, use_cache=True, catalog_path=None):
+    from thresholding_morphology import threshold_study, threshold_study_label_map
+    with _open_catalog(catalog_path) as catalog:
+        output_paths = []
+        for ct_path in study_series(study_dir, 'CT', catalog):
+            if label_map:
+                label_map_path = threshold_study_label_map(ct_path, ct_path.replace('.nii.gz', '_segmentation'),
+                                                           ct_path.replace('.nii.gz', '_intermediate'), use_cache=use_cache)[0]
+                if catalog is not None:
+                    catalog.add_artifacts(study_dir, 'dynamic_average_labels', [label_map_path], source=ct_path)
+                output_paths.append(label_map_path)
+                continue
+            bone_outputs = threshold_study(ct_path, ct_path.replace('.nii.gz', '_segmentation'), ct_path.replace('.nii.gz', '_intermediate'),
+                                           use_cache=use_cache)
+            if catalog is not None:
+                catalog.add_artifacts(study_dir, 'dynamic_average', bone_outputs, source=ct_path,
+                                      bones=[strip_extension(os.path.basename(p))[:-len('_dynamic_average')] for p in bone_outputs])
+            output_paths += bone_outputs
+        return output_paths
+
+def run_exclusion(study_dir, label_map=False, use_cache=True, catalog_path=None):
+    from metastatis_exclusion import exclude_metastasis, exclude_metastasis_label_map
+    with _open_catalog(catalog_path) as catalog:
+        if catalog is not None:
+            metastasis_paths = catalog.artifacts('metastasis_snr', study_dir)
+        else:
+            metastasis_paths = [stored_path(pt_path.replace('.nii.gz', '_metastasis_snr.nii.gz'), MASK_FORMAT) for pt_path in study_series(study_dir, 'PT')]
+        if not metastasis_paths:
+            raise ValueError(f"No metastasis mask found in {study_dir}")
+        output_paths = []
+        for ct_path in study_series(study_dir, 'CT', catalog):
+            if label_map:
+                label_map_path = stored_path(os.path.join(ct_path.replace('.nii.gz', '_intermediate'), 'dynamic_average_labels.nii.gz'), VOLUME_FORMAT)
+                marrow_label_map_path = exclude_metastasis_label_map(label_map_path, metastasis_paths[0], os.path.join(study_dir, 'marrow_segmentation'),
+                                                                     ResultCache(study_dir, 'metastasis_exclusion') if use_cache else None)[0]
+                if catalog is not None:
+                    catalog.add_artifacts(study_dir, 'marrow_labels', [marrow_label_map_path], source=ct_path)
+                output_paths.append(marrow_label_map_path)
+                continue
+            marrow_paths = exclude_metastasis(ct_path.replace('.nii.gz', '_intermediate'), metastasis_paths[0],
+                                              os.path.join(study_dir, 'marrow_segmentation'),
+                                              ResultCache(study_dir, 'metastasis_exclusion') if use_cache else None)
+            if catalog is not None:
+                catalog.add_artifacts(study_dir, 'marrow', marrow_paths, source=ct_path,
+                                      bones=[strip_extension(os.path.basename(p))[:-len('_marrow')] for p in marrow_paths])
+            output_paths += marrow_paths
+        return output_paths
+
+# With bone_rois, the RTSTRUCT also holds one ROI per bone, or per group of bones with roi_groups (see export_marrow_rtstruct)
+def run_export(study_dir, label_map=False, bone_rois=False, roi_groups=None, use_cache=True, catalog_path=None):
+    from nifti_to_rtstruct import export_marrow_rtstruct
+    with _open_catalog(catalog_path) as catalog:
+        marrow_dir = os.path.join(study_dir, 'marrow_segmentation')
+        if label_map:
+            marrow_paths = [stored_path(os.path.join(marrow_dir, 'marrow_labels.nii.gz'), VOLUME_FORMAT)]
+        elif catalog is not None:
+            marrow_paths = catalog.artifacts('marrow', study_dir)
+        else:
+            marrow_paths = sorted(os.path.join(marrow_dir, file) for file in os.listdir(marrow_dir)
+                                  if is_stored_volume(file) and 'marrow' in file and 'assembled' not in file and not is_label_map(file))
+        # rt_utils adds the .dcm extension to the study name
+        output_path = run_cached(study_dir, 'nifti_to_rtstruct', marrow_paths, {'roi_name': 'BoneMarrow', 'bone_rois': bone_rois, 'roi_groups': roi_groups},
+                                 os.path.join(marrow_dir, os.path.basename(study_dir) + '.dcm'),
+                                 lambda: export_marrow_rtstruct(marrow_dir, label_map, bone_rois, roi_groups), use_cache)
+        if catalog is not None:
+            catalog.add_artifacts(study_dir, 'assembled_marrow', [os.path.join(marrow_dir, 'assembled_marrow.nii.gz')])
+            catalog.add_artifacts(study_dir, 'rtstruct', [output_path])
+        return output_path
+
+# Every stage after the conversion in one process, with the volumes and masks kept in memory (see in_memory_pipeline.py)
+def run_in_memory(study_dir, save_intermediates=(), backend='totalsegmentator', cuda_devices=None, use_cache=True, catalog_path=None):
+    from in_memory_pipeline import process_study_in_memory, PER_BONE_INTERMEDIATES
+    from segmentation_backends import get_backend
+    from bone_seg import bones
+    with _open_catalog(catalog_path) as catalog:
+        ct_paths = study_series(study_dir, 'CT', catalog)
+        pt_paths = study_series(study_dir, 'PT', catalog)
+        if len(ct_paths) != 1 or not pt_paths:
+            raise ValueError(f"Found {len(ct_paths)} CT and {len(pt_paths)} PT files in {study_dir}")
+        dicom_dir = catalog.dicom_dir(ct_paths[0]) if catalog is not None else ct_paths[0].replace('.nii.gz', '_DICOM')
+        marrow_dir = os.path.join(study_dir, 'marrow_segmentation')
+        saved = {}
+        def compute():
+            saved.update(process_study_in_memory(ct_paths[0], pt_paths[0], dicom_dir, save_intermediates,
+                                                 backend=get_backend(backend, bones, **_backend_options(backend, cuda_devices)))[1])
+        output_path = run_cached(study_dir, 'in_memory', [ct_paths[0], pt_paths[0]],
+                                 {'save_intermediates': list(save_intermediates), 'backend': backend},
+                                 os.path.join(marrow_dir, os.path.basename(study_dir) + '.dcm'), compute, use_cache)
+        if catalog is not None:
+            for kind, paths in saved.items():
+                bones = [strip_extension(os.path.basename(p)).replace('_' + kind, '') for p in paths] if kind in PER_BONE_INTERMEDIATES else None
+                catalog.add_artifacts(study_dir, kind, paths, source=pt_paths[0] if kind == 'resized' else ct_paths[0], bones=bones)
+            catalog.add_artifacts(study_dir, 'rtstruct', [output_path])
+        return output_path
+
+# Stage name -> (function, stages it depends on, resource pool it runs on)
+# This is the run order of the README: spect_resizing overlaps bone_seg, snr_metastasis starts as soon as resizing ends
+STAGES = {
+    'dicom_to_nifti': (run_conversion, [], 'io'),
+    'bone_seg': (run_segmentation, ['dicom_to_nifti'], 'gpu'),
+    'spect_resizing': (run_resizing, ['dicom_to_nifti'], 'cpu'),
+    'snr_metastasis': (run_snr, ['spect_resizing'], 'cpu'),
+    'thresholding_morphology': (run_thresholding, ['bone_seg'], 'cpu'),
+    'metastasis_exclusion': (run_exclusion, ['snr_metastasis', 'thresholding_morphology'], 'io'),
+    'nifti_to_rtstruct': (run_export, ['metastasis_exclusion'], 'cpu'),
+    # Only run when asked for with in_memory=True, in place of every stage after the conversion
+    'in_memory': (run_in_memory, ['dicom_to_nifti'], 'gpu'),
+}
+IN_MEMORY_STAGES = ['dicom_to_nifti', 'in_memory']
+
+# Builds the per-study task graph: (study_dir, stage) -> keyword arguments of the stage function
+# With an input_dir the DICOM archive is indexed and converted first, otherwise the studies already in output_dir are used
+# Studies already converted are taken from the catalog at catalog_path when one is given
+def build_tasks(output_dir, input_dir=None, stages=None, staging='hardlink', use_cache=True, catalog_path=None):
+    stages = [stage for stage in STAGES if stage != 'in_memory'] if stages is None else stages
+    tasks = {}
+    if input_dir is not None:
+        from dicom_to_nifti import index_dicom_series, MODALITY_PREFIXES
+        studies = {}
+        for series_uid, info in index_dicom_series(input_dir, os.path.join(output_dir, 'dicom_index.json')).items():
+            if info['Modality'] in MODALITY_PREFIXES:
+                studies.setdefault(os.path.join(output_dir, info['StudyID']), []).append((series_uid, info))
+        for study_dir, series in studies.items():
+            if 'dicom_to_nifti' in stages:
+                tasks[(study_dir, 'dicom_to_nifti')] = {'series': series, 'staging': staging, 'use_cache': use_cache,
+                                                        'catalog_path': catalog_path}
+    elif catalog_path is not None:
+        with open_catalog(output_dir, catalog_path) as catalog:
+            studies = catalog.studies()
+    else:
+        studies = [os.path.join(output_dir, d) for d in sorted(os.listdir(output_dir)) if os.path.isdir(os.path.join(output_dir, d))]
+    for study_dir in studies:
+        for stage in stages:
+            if stage != 'dicom_to_nifti':
+                tasks[(study_dir, stage)] = {'use_cache': use_cache, 'catalog_path': catalog_path}
+    return tasks
+
+# Runs one task in its worker, traced as a span of the stage tagged with the study
+def run_task(function, stage, study_dir, kwargs):
+    with tags(study=os.path.basename(study_dir), stage=stage), span(stage):
+        return function(study_dir, **kwargs)
+
+# Runs the task graph, launching every task as soon as the tasks it depends on (in the same study) are done
+# CPU bound stages share cpu_workers processes, segmentation runs on gpu_workers processes and I/O bound stages
+# on io_workers threads, so a batch of studies flows through as a pipeline instead of stage by stage.
+# With use_cache, outputs up to date with their inputs and parameters (see result_cache.py) are not recomputed.
+# With use_catalog, stages find their inputs through the study catalog of output_dir (see study_catalog.py).
+# With marrow_label_map, the marrow stages pass one uint8 label map per study instead of one file per bone.
+# With rtstruct_bone_rois, the RTSTRUCT holds one ROI per bone (or per group of roi_groups) besides the whole marrow.
+# segmentation_backend names the bone segmentation backend, 'stub' runs without model weights or a GPU.
+# cuda_devices sets CUDA_VISIBLE_DEVICES in the GPU workers before TotalSegmentator is loaded, None keeps it as it is.
+# With in_memory, each study goes through a single in-memory task after its conversion, writing only the RTSTRUCT
+# and the intermediates listed in save_intermediates.
+# With trace_dir, every stage and step is traced there (see instrumentation.py), trace.json is the Chrome trace of the run.
+# Returns a dict of (study_dir, stage) -> 'done', 'failed' or 'skipped' (a dependency failed), and the failures' tracebacks
+def run_pipeline(output_dir, input_dir=None, stages=None, cpu_workers=None, io_workers=4, gpu_workers=1, staging='hardlink',
+                 use_cache=True, use_catalog=True, in_memory=False, save_intermediates=(), marrow_label_map=False,
+                 rtstruct_bone_rois=False, roi_groups=None, segmentation_backend='totalsegmentator', cuda_devices=None, trace_dir=None):
+    # Set before the workers start, so they trace to the same directory
+    if trace_dir is not None:
+        enable(trace_dir)
+    catalog_path = None
+    if use_catalog:
+        catalog_path = os.path.join(output_dir, CATALOG_NAME)
+        os.makedirs(output_dir, exist_ok=True)
+        open_catalog(output_dir, catalog_path).close()
+    if in_memory:
+        stages = IN_MEMORY_STAGES if stages is None else stages
+    tasks = build_tasks(output_dir, input_dir, stages, staging, use_cache, catalog_path)
+    for task, kwargs in tasks.items():
+        if task[1] == 'in_memory':
+            kwargs['save_intermediates'] = save_intermediates
+        if task[1] in ('bone_seg', 'in_memory'):
+            kwargs['backend'] = segmentation_backend
+            kwargs['cuda_devices'] = cuda_devices
+        elif task[1] in ('thresholding_morphology', 'metastasis_exclusion', 'nifti_to_rtstruct'):
+            kwargs['label_map'] = marrow_label_map
+        if task[1] == 'nifti_to_rtstruct':
+            kwargs['bone_rois'] = rtstruct_bone_rois
+            kwargs['roi_groups'] = roi_groups
+    status = {}
+    errors = {}
+    executors = {
+        'cpu': ProcessPoolExecutor(max_workers=cpu_workers),
+        'gpu': ProcessPoolExecutor(max_workers=gpu_workers),
+        'io': ThreadPoolExecutor(max_workers=io_workers),
+    }
+
+    # Dependencies on stages that are not part of this run are considered satisfied
+    def dependencies(task):
+        study_dir, stage = task
+        return [(study_dir, dependency) for dependency in STAGES[stage][1] if (study_dir, dependency) in tasks]
+
+    running = {}
+    try:
+        while len(status) < len(tasks):
+            for task, kwargs in tasks.items():
+                if task in status or task in running.values():
+                    continue
+                dependency_status = [status.get(dependency) for dependency in dependencies(task)]
+                if any(s in ('failed', 'skipped') for s in dependency_status):
+                    status[task] = 'skipped'
+                elif all(s == 'done' for s in dependency_status):
+                    function, _, resource = STAGES[task[1]]
+                    print(f"Starting {task[1]} for {task[0]}")
+                    running[executors[resource].submit(run_task, function, task[1], task[0], kwargs)] = task
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    future.result()
+                    status[task] = 'done'
+                    print(f"Finished {task[1]} for {task[0]}")
+                except Exception:
+                    status[task] = 'failed'
+                    errors[task] = traceback.format_exc()
+                    print(f"Failed {task[1]} for {task[0]}\n{errors[task]}")
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+    if trace_dir is not None:
+        write_chrome_trace(trace_dir, os.path.join(trace_dir, 'trace.json'))
+    return status, errors
+
+input_dir = '/radraid/apps/personal/tfrigerio/data_dir/lunar_quant/lunar_quant_dicom'
+root_dir = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_quant"
+# Directory of the trace of the run (see instrumentation.py), None to not trace
+trace_dir = None
+# GPUs visible to TotalSegmentator, None keeps CUDA_VISIBLE_DEVICES as it is
+cuda_devices = "1"
+
+if __name__ == "__main__":
+    t0 = time.time()
+    status, errors = run_pipeline(root_dir, input_dir, cpu_workers=8, io_workers=4, gpu_workers=1, cuda_devices=cuda_devices,
+                                  trace_dir=trace_dir)
+    print(f"{sum(s == 'done' for s in status.values())} tasks done, {len(errors)} failed")
+    t1 = time.time()
+    print("Total time: ", t1-t0)
@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+
+# Manifests live in a hidden directory of each study, one file per stage so that stages running
+# at the same time on the same study never write the same manifest
+CACHE_DIR = '.cache'
+CHUNK_SIZE = 1024**2
+
+# Content hash of a file, or of every file of a directory (names included), streamed in chunks
+def hash_path(path):
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for file in sorted(os.listdir(path)):
+            digest.update(file.encode())
+            digest.update(hash_path(os.path.join(path, file)).encode())
+        return digest.hexdigest()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _stat_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+# Per-study, per-stage manifest of outputs keyed by a hash of their input files and the stage parameters
+# An output is up to date when its key matches and the file is still the one that was recorded,
+# so changing one parameter or one input only recomputes the outputs that depend on it.
+# File hashes are remembered with the size and mtime of the file, unchanged inputs are not read again.
+class ResultCache:
+    def __init__(self, study_dir, stage):
+        self.path = os.path.join(study_dir, CACHE_DIR, stage + '.json')
+        self.outputs = {}
+        self.files = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.outputs = manifest['outputs']
+            self.files = manifest['files']
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        # Directories are always hashed again, their mtime doesn't follow changes to the files inside
+        if os.path.isdir(path):
+            return hash_path(path)
+        signature = _stat_signature(path)
+        if path in self.files and self.files[path][0] == signature:
+            return self.files[path][1]
+        file_hash = hash_path(path)
+        self.files[path] = [signature, file_hash]
+        return file_hash
+
+    def key(self, input_paths, params):
+        digest = hashlib.sha256()
+        for path in input_paths:
+            digest.update(self.file_hash(path).encode())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def is_up_to_date(self, output_path, key):
+        output_path = os.path.abspath(output_path)
+        entry = self.outputs.get(output_path)
+        return entry is not None and entry[0] == key and os.path.exists(output_path) and entry[1] == _stat_signature(output_path)
+
+    def record(self, output_path, key):
+        output_path = os.path.abspath(output_path)
+        self.outputs[output_path] = [key, _stat_signature(output_path)]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'outputs': self.outputs, 'files': self.files}, f)
+        os.replace(tmp_path, self.path)
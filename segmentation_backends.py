@@ -0,0 +1,83 @@
+import os
+import time
+import numpy as np
+import nibabel as nib
+import xmltodict
+
+# A segmentation backend turns a CT image into a multilabel image and its table of label -> class name:
+#   load()          sets the backend up once per process (imports, devices), later calls do nothing
+#   segment(image)  returns (multilabel image, dict of label -> class name)
+# roi_subset restricts the classes segmented to the ones listed, None segments every class
+
+def get_multilabel_nifti_header(img):
+    ext_header = img.header.extensions[0].get_content()
+    ext_header = xmltodict.parse(ext_header)
+    ext_header = ext_header["CaretExtension"]["VolumeInformation"]["LabelTable"]["Label"]
+    if isinstance(ext_header, dict):
+        ext_header = [ext_header]
+
+    label_map = {int(e["@Key"]): e["#text"] for e in ext_header}
+    return img, label_map
+
+# Adds a table of label -> class name to a multilabel image, in the header extension TotalSegmentator writes
+def add_label_table(img, label_map):
+    labels = [{"@Key": str(label), "#text": name} for label, name in label_map.items()]
+    xml = xmltodict.unparse({"CaretExtension": {"VolumeInformation": {"LabelTable": {"Label": labels}}}})
+    img.header.extensions.append(nib.nifti1.Nifti1Extension(0, xml.encode()))
+    return img
+
+class TotalSegmentatorBackend:
+    # cuda_devices, when given, is set as CUDA_VISIBLE_DEVICES before torch is first imported in the process
+    def __init__(self, roi_subset=None, device="gpu", fast=False, cuda_devices=None):
+        self.roi_subset = roi_subset
+        self.device = device
+        self.fast = fast
+        self.cuda_devices = cuda_devices
+        self._totalsegmentator = None
+
+    def load(self):
+        if self._totalsegmentator is not None:
+            return
+        if self.cuda_devices is not None:
+            os.environ["CUDA_VISIBLE_DEVICES"] = self.cuda_devices
+        from totalsegmentator.python_api import totalsegmentator
+        self._totalsegmentator = totalsegmentator
+
+    def segment(self, image):
+        self.load()
+        masks = self._totalsegmentator(image, roi_subset=self.roi_subset, device=self.device, fast=self.fast)
+        return get_multilabel_nifti_header(masks)
+
+# CPU only stand-in for throughput tests, without model weights or a GPU: voxels above bone_hu are labelled by axial
+# band, one band per class of roi_subset, and delay seconds of inference time are simulated per CT
+class StubBackend:
+    def __init__(self, roi_subset=None, bone_hu=150, delay=0.0):
+        self.roi_subset = roi_subset if roi_subset is not None else ["bone"]
+        self.bone_hu = bone_hu
+        self.delay = delay
+
+    def load(self):
+        pass
+
+    def segment(self, image):
+        array = np.asanyarray(image.dataobj)
+        label_map = dict(enumerate(self.roi_subset, start=1))
+        bands = np.arange(array.shape[2]) * len(label_map) // array.shape[2] + 1
+        bands = bands.reshape((1, 1, -1) + (1,) * (array.ndim - 3))
+        label_array = np.where(array > self.bone_hu, bands, 0).astype(np.uint8)
+        if self.delay:
+            time.sleep(self.delay)
+        return add_label_table(nib.Nifti1Image(label_array, image.affine), label_map), label_map
+
+BACKENDS = {"totalsegmentator": TotalSegmentatorBackend, "stub": StubBackend}
+
+_backends = {}
+
+# Backend of that name, loaded once per process and reused by every later call with the same roi_subset
+def get_backend(name="totalsegmentator", roi_subset=None, **options):
+    key = (name, tuple(roi_subset) if roi_subset is not None else None, tuple(sorted(options.items())))
+    if key not in _backends:
+        backend = BACKENDS[name](roi_subset, **options)
+        backend.load()
+        _backends[key] = backend
+    return _backends[key]
@@ -1,35 +1,98 @@
 import nibabel as nib
 import numpy as np
 import os
+from study_catalog import open_catalog
+from instrumentation import span
+from volume_storage import MASK_FORMAT, EXTENSIONS, load_image, open_image, save_mask, mask_image, stored_path, strip_extension, find_stored, PackedMaskWriter
 
-def load_image(image_path):
-    image = nib.load(image_path)
-    image_array = image.get_fdata()
-    return image, image_array
-
+# Boolean mask of the voxels at or above threshold_down
 def threshold_image(image_array, threshold_up, threshold_down):
-    bone_array_mask = np.zeros(image_array.shape)
-    #bone_array_mask[image_array < threshold_up] = 1
-    bone_array_mask[image_array >= threshold_down] = 1
+    #bone_array_mask = (image_array < threshold_up)
+    bone_array_mask = image_array >= threshold_down
     return bone_array_mask
 
+# Voxels at or above this signal-to-noise ratio are flagged as metastasis
+SNR_THRESHOLD = 5
+# Axial slices read at a time by the chunked mode, a multiple of volume_storage.CHUNK_SLICES
+SLAB_SLICES = 64
+
+# Mean and (population) standard deviation of a volume from a single pass over slabs of slab_slices axial slices,
+# the statistics of each slab being merged into the running ones (Chan et al. / Welford update)
+def streaming_mean_std(dataobj, slab_slices=SLAB_SLICES):
+    count, mean, m2 = 0, 0.0, 0.0
+    for z_start in range(0, dataobj.shape[2], slab_slices):
+        slab = np.asarray(dataobj[:, :, z_start:z_start + slab_slices], dtype=np.float64)
+        slab_count = slab.size
+        if slab_count == 0:
+            continue
+        slab_mean = slab.mean()
+        slab_m2 = np.square(slab - slab_mean).sum()
+        delta = slab_mean - mean
+        total = count + slab_count
+        mean += delta * slab_count / total
+        m2 += slab_m2 + delta**2 * count * slab_count / total
+        count = total
+    return mean, np.sqrt(m2 / count)
+
+# Flags voxels of the resized SPECT whose signal-to-noise ratio (value over the standard deviation of the volume)
+# reaches snr_threshold, and saves the mask next to it as *_metastasis_snr in the intermediate mask format
+def detect_metastasis(file_path, snr_threshold=SNR_THRESHOLD):
+    image, image_array = load_image(file_path)
+
+    snr_array = image_array/np.std(image_array)
+    metastsis_array = threshold_image(snr_array, 10000000000000000000, snr_threshold)
+    metastasis_image = mask_image(metastsis_array, affine=None, header=image.header)
+    output_path = strip_extension(file_path)[:-len('resized')] + 'metastasis_snr.nii.gz'
+    return save_mask(metastasis_image, output_path)
+
+# Same as detect_metastasis, reading the resized SPECT slab by slab (memory mapped when stored uncompressed): one pass
+# for the standard deviation, one pass to threshold each slab. With the 'packed' mask format each slab goes straight
+# to the packed output, so the memory used doesn't depend on the size of the volume; other formats fill a bool mask.
+# It pays off for memory, not time: a .nii.gz is decompressed twice (about 2x the time of detect_metastasis on a
+# 256x256x600 SPECT), so it is worth it when several float copies of the whole volume don't fit, e.g. long axial
+# ranges or many studies run in parallel. Volumes stored uncompressed ('nii') are mapped and cost no extra decompression.
+def detect_metastasis_chunked(file_path, snr_threshold=SNR_THRESHOLD, slab_slices=SLAB_SLICES):
+    image = open_image(file_path)
+    with span('streaming_std'):
+        _, std = streaming_mean_std(image.dataobj, slab_slices)
+    output_path = stored_path(strip_extension(file_path)[:-len('resized')] + 'metastasis_snr.nii.gz', MASK_FORMAT)
+
+    def slabs():
+        for z_start in range(0, image.shape[2], slab_slices):
+            snr_slab = np.asarray(image.dataobj[:, :, z_start:z_start + slab_slices], dtype=np.float64) / std
+            yield z_start, threshold_image(snr_slab, 10000000000000000000, snr_threshold)
+
+    if MASK_FORMAT == 'packed':
+        header = image.header.copy()
+        header.set_data_dtype(np.uint8)
+        with span('threshold_slabs'), PackedMaskWriter(output_path, image.shape, image.affine, header) as writer:
+            for _, metastasis_slab in slabs():
+                writer.write(metastasis_slab)
+        return output_path
+    with span('threshold_slabs'):
+        metastasis_array = np.zeros(image.shape, dtype=bool)
+        for z_start, metastasis_slab in slabs():
+            metastasis_array[:, :, z_start:z_start + metastasis_slab.shape[2]] = metastasis_slab
+    with span('save'):
+        return save_mask(mask_image(metastasis_array, affine=image.affine, header=image.header), output_path)
+
+# Detector for the resized SPECT at file_path: detect_metastasis_chunked when the SPECT is stored uncompressed (mapped,
+# no extra decompression) or the mask goes to the 'packed' store (bounded memory), detect_metastasis otherwise
+def metastasis_detector(file_path):
+    if MASK_FORMAT == 'packed' or find_stored(file_path).endswith(EXTENSIONS['nii']):
+        return detect_metastasis_chunked
+    return detect_metastasis
+
 root_dir = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_quant"
 # studylist = os.listdir(data_dir)
 # studylist = [i for i in studylist if 'no_quant' not in i]
 
 if __name__ == "__main__":
 
-    for subdir, _, files in os.walk(root_dir):
-        for scan in files:
-
-            if scan.endswith('.nii.gz') and 'PT' in scan and 'resized' in scan and 'metastasis' not in scan:
-                print("Processing file: ", scan)
-                file_path = os.path.join(subdir, scan)
-
-                image, image_array = load_image(file_path)
- 
-                snr_array = image_array/np.std(image_array)
-                metastsis_array = threshold_image(snr_array, 10000000000000000000, 5)
-                metastasis_image = nib.Nifti1Image(metastsis_array, affine=None, header=image.header)
-                nib.save(metastasis_image, os.path.join(file_path.replace('resized.nii.gz', 'metastasis_snr.nii.gz')))
-                print("Found and processed file: ", file_path)
\ No newline at end of file
+    catalog = open_catalog(root_dir)
+    for study_dir in catalog.studies():
+        for file_path in catalog.artifacts('resized', study_dir):
+            print("Processing file: ", file_path)
+            output_path = metastasis_detector(file_path)(file_path)
+            catalog.add_artifacts(study_dir, 'metastasis_snr', [output_path], source=file_path)
+            print("Found and processed file: ", file_path)
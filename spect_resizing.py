@@ -1,16 +1,156 @@
 import numpy as np
 import os
 import nibabel as nib
-from scipy.ndimage import zoom, map_coordinates
+from scipy.ndimage import zoom, affine_transform, spline_filter
+from study_catalog import open_catalog
+from instrumentation import span
+from volume_storage import VOLUME_FORMAT, save_volume, stored_path
 
+# Default working-memory ceiling of the resampling, in bytes
+DEFAULT_MAX_MEMORY_BYTES = 512 * 1024**2
 
-def resize_spect_to_ct(spect_path, ct_path, output_path, interpolation_order=1):
+# Resampling plans already computed, keyed by the geometry of the data and reference grids
+_resampling_plans = {}
+MAX_CACHED_PLANS = 32
+
+def _corners(start, stop):
+    return np.array([[x, y, z, 1.0] for x in (start[0], stop[0]) for y in (start[1], stop[1]) for z in (start[2], stop[2])])
+
+def get_resampling_plan(data_shape, data_affine, reference_shape, reference_affine, interpolation_order=1):
+    """
+    Compute (or fetch from the cache) the mapping from a reference grid to a data grid.
+
+    Plans are cached by the pair of geometries (shape and affine of both grids) and the
+    interpolation order, so several SPECT series sharing one CT only compute it once.
+
+    Parameters:
+    -----------
+    data_shape : tuple
+        Spatial shape of the data to resample
+    data_affine : numpy.ndarray
+        4x4 voxel to world affine of the data
+    reference_shape : tuple
+        Spatial shape of the reference grid
+    reference_affine : numpy.ndarray
+        4x4 voxel to world affine of the reference grid
+    interpolation_order : int, optional
+        Order of interpolation, sets how far outside the data grid a sample can still be non-zero
+
+    Returns:
+    --------
+    dict
+        'matrix' and 'offset' of the composed reference voxel -> data voxel affine,
+        'output_box' the slices of the reference grid that overlap the data (None if they don't)
+        and 'input_box' the slices of the data needed to fill them
+    """
+    data_shape = tuple(data_shape[:3])
+    reference_shape = tuple(reference_shape[:3])
+    key = (data_shape, np.asarray(data_affine, dtype=np.float64).tobytes(),
+           reference_shape, np.asarray(reference_affine, dtype=np.float64).tobytes(), interpolation_order)
+    if key in _resampling_plans:
+        return _resampling_plans[key]
+
+    composed_affine = np.linalg.inv(data_affine) @ reference_affine
+    margin = interpolation_order + 1
+
+    # Reference voxels outside the image of the (padded) data grid only ever sample the constant 0
+    data_corners = _corners(np.full(3, -margin), np.array(data_shape) - 1 + margin)
+    reference_corners = (data_corners @ np.linalg.inv(composed_affine).T)[:, :3]
+    output_start = np.clip(np.floor(reference_corners.min(axis=0)), 0, reference_shape).astype(int)
+    output_stop = np.clip(np.ceil(reference_corners.max(axis=0)) + 1, 0, reference_shape).astype(int)
+
+    plan = {'matrix': composed_affine[:3, :3], 'offset': composed_affine[:3, 3], 'output_box': None, 'input_box': None}
+    if np.all(output_stop > output_start):
+        # Only the part of the data reached from the output box (plus the interpolation support) is kept
+        sampled_corners = (_corners(output_start, output_stop - 1) @ composed_affine.T)[:, :3]
+        input_start = np.clip(np.floor(sampled_corners.min(axis=0)) - margin, 0, data_shape).astype(int)
+        input_stop = np.clip(np.ceil(sampled_corners.max(axis=0)) + 1 + margin, 0, data_shape).astype(int)
+        plan['output_box'] = tuple(slice(a, b) for a, b in zip(output_start, output_stop))
+        plan['input_box'] = tuple(slice(a, b) for a, b in zip(input_start, input_stop))
+        # Offset of the cropped data sampled from the first voxel of the output box
+        plan['offset'] = composed_affine[:3, 3] + composed_affine[:3, :3] @ output_start - input_start
+
+    if len(_resampling_plans) >= MAX_CACHED_PLANS:
+        _resampling_plans.pop(next(iter(_resampling_plans)))
+    _resampling_plans[key] = plan
+    return plan
+
+def resample_to_reference(data, data_affine, reference_shape, reference_affine, interpolation_order=1,
+                          max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES):
+    """
+    Resample a 3D volume, or every frame of a 4D volume, onto the voxel grid of a reference image.
+
+    The reference voxel -> world -> data voxel mapping is composed into a single affine and
+    applied with scipy.ndimage.affine_transform, so no coordinate grid is ever built. Only the
+    part of the reference grid overlapping the data is sampled, filled in slabs along z, each slab
+    small enough to keep the working memory of a call under max_memory_bytes. Frames of a 4D
+    volume (4th axis) are resampled together, with an identity mapping along the frame axis.
+
+    Parameters:
+    -----------
+    data : numpy.ndarray
+        3D volume, or 4D volume with frames along the last axis, to resample
+    data_affine : numpy.ndarray
+        4x4 voxel to world affine of data
+    reference_shape : tuple
+        Shape of the reference grid
+    reference_affine : numpy.ndarray
+        4x4 voxel to world affine of the reference grid
+    interpolation_order : int, optional
+        Order of interpolation (0: nearest, 1: linear, 3: cubic)
+    max_memory_bytes : int, optional
+        Working-memory ceiling of a single slab, None resamples the whole volume in one call
+
+    Returns:
+    --------
+    numpy.ndarray
+        The resampled float64 volume of shape reference_shape (plus the frame axis for 4D data)
+    """
+    reference_shape = tuple(reference_shape[:3])
+    plan = get_resampling_plan(data.shape, data_affine, reference_shape, reference_affine, interpolation_order)
+    frames = data.shape[3:]
+    resampled = np.zeros(reference_shape + frames, dtype=np.float64)
+    if plan['output_box'] is None:
+        return resampled
+
+    # The spline prefilter is computed once on the whole volume (not on the crop) instead of once per slab
+    if interpolation_order > 1:
+        data = spline_filter(data, order=interpolation_order, output=np.float64)
+    data = data[plan['input_box']]
+
+    # Identity along the frame axis, so all frames go through the same mapping in one call
+    matrix = np.eye(data.ndim)
+    matrix[:3, :3] = plan['matrix']
+    offset = np.zeros(data.ndim)
+    offset[:3] = plan['offset']
+
+    output = resampled[plan['output_box']]
+    slice_bytes = output.shape[0] * output.shape[1] * int(np.prod(frames)) * resampled.itemsize
+    if max_memory_bytes is None:
+        slab_depth = output.shape[2]
+    else:
+        slab_depth = max(1, int(max_memory_bytes // slice_bytes))
+
+    for z_start in range(0, output.shape[2], slab_depth):
+        z_stop = min(z_start + slab_depth, output.shape[2])
+        # Output voxel (i, j, k) of the slab is voxel (i, j, k + z_start) of the output box
+        slab_offset = offset.copy()
+        slab_offset[:3] += plan['matrix'][:, 2] * z_start
+        affine_transform(data, matrix, offset=slab_offset,
+                         output_shape=output[:, :, z_start:z_stop].shape,
+                         output=output[:, :, z_start:z_stop], order=interpolation_order,
+                         mode='constant', cval=0.0, prefilter=False)
+    return resampled
+
+
+def resize_spect_to_ct(spect_path, ct_path, output_path, interpolation_order=1, max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES):
     """
     Resize a SPECT scan to match the shape and spatial coordinates of a CT scan.
     This function first aligns the scans in real-world coordinates, then crops 
     the SPECT scan accordingly, and finally resamples it to match the CT dimensions.
     
-    Handles 4D SPECT data where the 4th dimension might have length 1.
+    Handles 4D SPECT data: a 4th dimension of length 1 is squeezed, and dynamic SPECT
+    frames along the 4th dimension are all resampled with the same plan.
     
     Parameters:
     -----------
@@ -19,10 +159,13 @@ def resize_spect_to_ct(spect_path, ct_path, output_path, interpolation_order=1):
     ct_path : str
         Path to the CT NIfTI file that will be used as the reference
     output_path : str
-        Path where the resized SPECT NIfTI file will be saved
+        Path where the resized SPECT NIfTI file will be saved, its extension
+        follows volume_storage.VOLUME_FORMAT
     interpolation_order : int, optional
         Order of interpolation (0: nearest, 1: linear, 3: cubic)
         Default is 1 (linear/bilinear)
+    max_memory_bytes : int, optional
+        Working-memory ceiling of the resampling, see resample_to_reference
     
     Returns:
     --------
@@ -51,33 +194,10 @@ def resize_spect_to_ct(spect_path, ct_path, output_path, interpolation_order=1):
         # Squeeze the data to make it 3D for processing
         spect_data = np.squeeze(spect_data, axis=3)
     
-    # Create a grid of voxel coordinates for the CT image
-    ct_grid = np.array(np.meshgrid(
-        np.arange(ct_shape[0]),
-        np.arange(ct_shape[1]),
-        np.arange(ct_shape[2]),
-        indexing='ij'
-    ))
-    
-    # Reshape the grid to a list of voxel coordinates
-    ct_voxels = ct_grid.reshape(3, -1).T
-    
-    # Add a column of ones for homogeneous coordinates
-    ct_voxels_homog = np.hstack((ct_voxels, np.ones((ct_voxels.shape[0], 1))))
-    
-    # Convert CT voxel coordinates to world coordinates
-    ct_world = ct_voxels_homog @ ct_affine.T
-    
-    # Convert world coordinates to SPECT voxel coordinates
-    spect_voxels_homog = ct_world @ np.linalg.inv(spect_affine).T
-    spect_voxels = spect_voxels_homog[:, :3]
-    
-    # Reshape the coordinates back to the grid shape for sampling
-    spect_coords = spect_voxels.T.reshape(3, *ct_shape)
-    
-    # Sample the SPECT data at the calculated coordinates using interpolation
-    resampled_spect = map_coordinates(spect_data, spect_coords, order=interpolation_order, 
-                                     mode='constant', cval=0.0)
+    # Sample the SPECT data on the CT grid using interpolation
+    with span('resample'):
+        resampled_spect = resample_to_reference(spect_data, spect_affine, ct_shape, ct_affine,
+                                                interpolation_order, max_memory_bytes)
     
     # If the original was 4D with singleton dimension, restore that dimension
     if is_4d_singleton:
@@ -90,16 +210,14 @@ def resize_spect_to_ct(spect_path, ct_path, output_path, interpolation_order=1):
     ct_header = ct_img.header.copy()
     
     # Update dimensions in the header to match the actual data
-    if is_4d_singleton:
-        ct_header.set_data_shape((*ct_shape, 1))
-    else:
-        ct_header.set_data_shape(ct_shape)
+    ct_header.set_data_shape(resampled_spect.shape)
     
     # Assign the updated header
     # resampled_img.header = ct_header
     
-    # Save the resampled image
-    nib.save(resampled_img, output_path)
+    # Save the resampled image in the intermediate volume format
+    with span('save'):
+        output_path = save_volume(resampled_img, output_path)
     
     print(f"Resized SPECT scan saved to {output_path}")
     print(f"Original SPECT shape: {original_shape}, New shape: {resampled_spect.shape}")
@@ -140,33 +258,15 @@ root_dir = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_qua
 
 if __name__ == "__main__":
 
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith('.nii') or file.endswith('.nii.gz') and 'PT' in file and 'resized' not in file:
-                file_path = os.path.join(subdir, file)
-
-                # Find corresponding CT file
-                ct_file_counter = 0
-                for ct_file in files:
-                    if ct_file.endswith('.nii') or ct_file.endswith('.nii.gz') and 'CT' in ct_file:
-                        ct_file_path = os.path.join(subdir, ct_file)
-                        ct_file_counter += 1
-                if ct_file_counter != 1:
-                    print(f"Error: Found {ct_file_counter} CT files for {file_path}")
-                    continue
-                print(f"Processing file: {file_path}")
-                resize_spect_to_ct(file_path, ct_file_path, file_path.replace('.nii.gz', '_resized.nii.gz'))
+    catalog = open_catalog(root_dir)
+    for study_dir in catalog.studies():
+        # Find corresponding CT file
+        ct_file_paths = catalog.series(study_dir, 'CT')
+        for file_path in catalog.series(study_dir, 'PT'):
+            if len(ct_file_paths) != 1:
+                print(f"Error: Found {len(ct_file_paths)} CT files for {file_path}")
                 continue
-                image = nib.load(file_path)
-                ct_image = nib.load(ct_file_path)
-                new_header = ct_image.header
-                if len(image.shape) == 4:
-                    new_image_data = image.get_fdata()[:, :, :, 0]
-                else:
-                    new_image_data = image.get_fdata()
-                new_affine = ct_image.affine
-                new_shape = ct_image.shape
-                resized_image = resize_nifti(new_image_data, new_affine, new_header, new_shape)
-                resized_file_path = os.path.join(subdir, f"{file.replace('.nii.gz','')}_resized.nii.gz")
-                nib.save(resized_image, resized_file_path)
-                print(f"Resized file saved: {resized_file_path}")
+            print(f"Processing file: {file_path}")
+            output_path = stored_path(file_path.replace('.nii.gz', '_resized.nii.gz'), VOLUME_FORMAT)
+            resize_spect_to_ct(file_path, ct_file_paths[0], output_path)
+            catalog.add_artifacts(study_dir, 'resized', [output_path], source=file_path)
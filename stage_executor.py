@@ -0,0 +1,141 @@
+import os
+import tempfile
+import threading
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from utility_functions import full_pipeline, load_native_array
+
+# Shared volumes are written to RAM backed storage when available so that workers map them without a disk round trip
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# Volume currently mapped by a worker process, kept between tasks of the same study
+_worker_volume = {}
+
+# Maps a shared volume in a worker, the previous study's volume is released when a new one is requested
+def _open_shared_volume(volume_path):
+    if volume_path not in _worker_volume:
+        _worker_volume.clear()
+        _worker_volume[volume_path] = np.load(volume_path, mmap_mode='r')
+    return _worker_volume[volume_path]
+
+# Runs full_pipeline for one bone in a worker, errors are returned instead of raised so that the run goes on
+def _run_bone(volume_path, bone_mask_path, output_path, args, kwargs):
+    try:
+        full_pipeline(_open_shared_volume(volume_path), bone_mask_path, output_path, *args, **kwargs)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+# Process pool for the thresholding-morphology stage
+# The decoded CT of each study is written once to a memory mapped .npy file that every worker maps read-only,
+# so no copy of the volume is pickled per task. Bones are scheduled largest first (by mask file size) to avoid
+# waiting on stragglers, and at most max_studies_in_flight CT volumes are kept shared at any time.
+# Failed tasks are collected in errors as (bone_mask_path, traceback) pairs.
+class ThresholdingExecutor:
+    def __init__(self, n_workers=None, max_studies_in_flight=2, volume_cache=None):
+        self.pool = ProcessPoolExecutor(max_workers=n_workers)
+        self.volume_cache = volume_cache
+        self.studies_in_flight = threading.BoundedSemaphore(max_studies_in_flight)
+        self.lock = threading.Lock()
+        self.errors = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    # Shares the CT at image_path with the workers and submits one task per (bone_mask_path, output_path) pair
+    # args and kwargs are passed on to full_pipeline after the image, mask and output paths
+    # With a result_cache, tasks whose outputs are up to date with the CT, the mask and cache_params are skipped,
+    # and the outputs of successful tasks are recorded in it, saved once the last task of the study is done
+    # A mask (or CT) that can't be read fails its tasks in errors, the other tasks of the study still run
+    def submit_study(self, image_path, tasks, *args, result_cache=None, cache_params=None, **kwargs):
+        keys = {}
+        sized_tasks = []
+        for bone_mask_path, output_path in tasks:
+            try:
+                size = os.path.getsize(bone_mask_path)
+                if result_cache is not None:
+                    keys[output_path] = result_cache.key([image_path, bone_mask_path], cache_params)
+                    if result_cache.is_up_to_date(output_path, keys[output_path]):
+                        continue
+            except Exception:
+                self._fail(bone_mask_path)
+                continue
+            sized_tasks.append((size, bone_mask_path, output_path))
+        tasks = [(bone_mask_path, output_path) for _, bone_mask_path, output_path in sorted(sized_tasks, key=lambda task: task[0], reverse=True)]
+        if not tasks:
+            return []
+        self.studies_in_flight.acquire()
+        volume_path = None
+        try:
+            if self.volume_cache is not None:
+                image_array = self.volume_cache.get(image_path)
+            else:
+                _, image_array = load_native_array(image_path)
+            file_descriptor, volume_path = tempfile.mkstemp(suffix='.npy', dir=SHARED_DIR)
+            os.close(file_descriptor)
+            shared_array = np.lib.format.open_memmap(volume_path, mode='w+', dtype=image_array.dtype, shape=image_array.shape)
+            shared_array[...] = image_array
+            shared_array.flush()
+            del shared_array, image_array
+        except Exception:
+            # Nothing was submitted, the slot of the study is given back and every task of the study fails
+            if volume_path is not None and os.path.exists(volume_path):
+                os.remove(volume_path)
+            self.studies_in_flight.release()
+            for bone_mask_path, _ in tasks:
+                self._fail(bone_mask_path)
+            return []
+        if self.volume_cache is not None:
+            # The workers only read the shared copy, keeping the cached one would hold the CT in memory twice
+            self.volume_cache.evict(image_path)
+
+        remaining = [len(tasks)]
+        futures = []
+        for submitted, (bone_mask_path, output_path) in enumerate(tasks):
+            try:
+                future = self.pool.submit(_run_bone, volume_path, bone_mask_path, output_path, args, kwargs)
+            except BaseException:
+                # The tasks left out never complete, the study is finished once the submitted ones are
+                self._tasks_finished(len(tasks) - submitted, volume_path, remaining, result_cache)
+                raise
+            future.add_done_callback(lambda f, task=(bone_mask_path, output_path):
+                                     self._task_done(f, task, volume_path, remaining, result_cache, keys))
+            futures.append(future)
+        return futures
+
+    # Records the exception being handled as the failure of the task of bone_mask_path
+    def _fail(self, bone_mask_path):
+        with self.lock:
+            self.errors.append((bone_mask_path, traceback.format_exc()))
+
+    def _task_done(self, future, task, volume_path, remaining, result_cache, keys):
+        bone_mask_path, output_path = task
+        error = future.exception() or future.result()
+        with self.lock:
+            if error is not None:
+                self.errors.append((bone_mask_path, str(error)))
+            elif result_cache is not None:
+                result_cache.record(output_path, keys[output_path])
+        self._tasks_finished(1, volume_path, remaining, result_cache)
+
+    # Counts n tasks of a study as finished. After the last one the cache is saved once for the whole study, and the
+    # shared volume and the slot of the study are released
+    def _tasks_finished(self, n, volume_path, remaining, result_cache):
+        with self.lock:
+            remaining[0] -= n
+            study_finished = remaining[0] == 0
+            if study_finished and result_cache is not None:
+                result_cache.save()
+        if study_finished:
+            # Workers still holding the mapping keep it valid until they move on to another study
+            os.remove(volume_path)
+            self.studies_in_flight.release()
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+        for bone_mask_path, error in self.errors:
+            print(f"Failed: {bone_mask_path}\n{error}")
@@ -0,0 +1,155 @@
+import os
+import sqlite3
+from volume_storage import is_stored_volume, strip_extension, LABEL_MAP_SUFFIX
+
+CATALOG_NAME = 'catalog.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS series (
+    path TEXT PRIMARY KEY,
+    study_dir TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    series_uid TEXT,
+    dicom_dir TEXT
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    study_dir TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    source TEXT,
+    bone TEXT
+);
+CREATE INDEX IF NOT EXISTS series_by_study ON series (study_dir, modality);
+CREATE INDEX IF NOT EXISTS artifacts_by_study ON artifacts (study_dir, kind);
+CREATE INDEX IF NOT EXISTS artifacts_by_source ON artifacts (source, kind);
+'''
+
+# Kinds of derived artifacts, by the stage producing them:
+# bone_seg -> 'bone_mask', spect_resizing -> 'resized', snr_metastasis -> 'metastasis_snr',
+# thresholding_morphology -> 'dynamic_average', metastasis_exclusion -> 'marrow',
+# nifti_to_rtstruct -> 'assembled_marrow' and 'rtstruct'
+# In label map mode, thresholding_morphology -> 'dynamic_average_labels' and metastasis_exclusion -> 'marrow_labels'
+MODALITIES = ['CT', 'PT', 'MR']
+
+# Persistent SQLite catalog of the studies of a project tree: the converted series of each study and the
+# artifacts derived from them. The converter and every stage register what they write, and stages look up
+# their inputs per study instead of walking the whole tree and matching file names.
+class StudyCatalog:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Several stages may update the catalog at the same time from different processes
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def add_series(self, study_dir, modality, path, series_uid=None, dicom_dir=None):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?)',
+                                    (path, study_dir, modality, series_uid, dicom_dir))
+
+    def add_artifacts(self, study_dir, kind, paths, source=None, bones=None):
+        bones = [None] * len(paths) if bones is None else bones
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)',
+                                        [(path, study_dir, kind, source, bone) for path, bone in zip(paths, bones)])
+
+    def studies(self):
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT study_dir FROM series ORDER BY study_dir')]
+
+    # Paths of the converted series, optionally restricted to a study and a modality
+    def series(self, study_dir=None, modality=None):
+        query, params = 'SELECT path FROM series WHERE 1', []
+        if study_dir is not None:
+            query, params = query + ' AND study_dir = ?', params + [study_dir]
+        if modality is not None:
+            query, params = query + ' AND modality = ?', params + [modality]
+        return [row[0] for row in self.connection.execute(query + ' ORDER BY path', params)]
+
+    def dicom_dir(self, series_path):
+        row = self.connection.execute('SELECT dicom_dir FROM series WHERE path = ?', (series_path,)).fetchone()
+        return None if row is None else row[0]
+
+    # Paths of the artifacts of a kind, optionally restricted to a study or to the series/artifact they derive from
+    def artifacts(self, kind, study_dir=None, source=None):
+        query, params = 'SELECT path FROM artifacts WHERE kind = ?', [kind]
+        if study_dir is not None:
+            query, params = query + ' AND study_dir = ?', params + [study_dir]
+        if source is not None:
+            query, params = query + ' AND source = ?', params + [source]
+        return [row[0] for row in self.connection.execute(query + ' ORDER BY path', params)]
+
+    def bone(self, artifact_path):
+        row = self.connection.execute('SELECT bone FROM artifacts WHERE path = ?', (artifact_path,)).fetchone()
+        return None if row is None else row[0]
+
+    # Fills the catalog from a tree written before the catalog existed, with a single walk
+    # Studies are the top-level directories of root_dir, laid out as written by the pipeline stages
+    def index_tree(self, root_dir):
+        for study in sorted(os.listdir(root_dir)):
+            study_dir = os.path.join(root_dir, study)
+            if not os.path.isdir(study_dir):
+                continue
+            for file in sorted(os.listdir(study_dir)):
+                path = os.path.join(study_dir, file)
+                modality = file.split('_')[0]
+                if os.path.isdir(path) or not is_stored_volume(file):
+                    continue
+                # Intermediates may be stored in any of the formats of volume_storage.py, the series are always .nii.gz
+                stem = strip_extension(path)
+                if stem.endswith('_resized'):
+                    self.add_artifacts(study_dir, 'resized', [path], source=stem[:-len('_resized')] + '.nii.gz')
+                elif stem.endswith('_metastasis_snr'):
+                    resized_stem = stem[:-len('_metastasis_snr')] + '_resized'
+                    resized = [resized_stem + ext for ext in ('.nii.gz', '.nii') if os.path.exists(resized_stem + ext)]
+                    self.add_artifacts(study_dir, 'metastasis_snr', [path], source=resized[0] if resized else resized_stem + '.nii.gz')
+                elif modality in MODALITIES and file.endswith('.nii.gz'):
+                    dicom_dir = path.replace('.nii.gz', '_DICOM')
+                    if not os.path.isdir(dicom_dir):
+                        dicom_dir = dicom_dir + '.json' if os.path.exists(dicom_dir + '.json') else None
+                    self.add_series(study_dir, modality, path, dicom_dir=dicom_dir)
+                    self._index_derived_dirs(study_dir, path)
+            marrow_dir = os.path.join(study_dir, 'marrow_segmentation')
+            if os.path.isdir(marrow_dir):
+                for file in sorted(os.listdir(marrow_dir)):
+                    path = os.path.join(marrow_dir, file)
+                    if file == 'assembled_marrow.nii.gz':
+                        self.add_artifacts(study_dir, 'assembled_marrow', [path])
+                    elif is_stored_volume(file) and strip_extension(file) == 'marrow' + LABEL_MAP_SUFFIX:
+                        self.add_artifacts(study_dir, 'marrow_labels', [path])
+                    elif is_stored_volume(file) and strip_extension(file).endswith('_marrow'):
+                        self.add_artifacts(study_dir, 'marrow', [path], bones=[strip_extension(file)[:-len('_marrow')]])
+                    elif file.endswith('.dcm'):
+                        self.add_artifacts(study_dir, 'rtstruct', [path])
+
+    def _index_derived_dirs(self, study_dir, series_path):
+        segmentation_dir = series_path.replace('.nii.gz', '_segmentation')
+        if os.path.isdir(segmentation_dir):
+            files = sorted(f for f in os.listdir(segmentation_dir) if is_stored_volume(f))
+            self.add_artifacts(study_dir, 'bone_mask', [os.path.join(segmentation_dir, f) for f in files], source=series_path,
+                               bones=[strip_extension(f) for f in files])
+        intermediate_dir = series_path.replace('.nii.gz', '_intermediate')
+        if os.path.isdir(intermediate_dir):
+            files = sorted(f for f in os.listdir(intermediate_dir) if is_stored_volume(f) and strip_extension(f).endswith('_dynamic_average'))
+            label_maps = [f for f in os.listdir(intermediate_dir) if is_stored_volume(f) and strip_extension(f) == 'dynamic_average' + LABEL_MAP_SUFFIX]
+            self.add_artifacts(study_dir, 'dynamic_average_labels', [os.path.join(intermediate_dir, f) for f in label_maps], source=series_path)
+            self.add_artifacts(study_dir, 'dynamic_average', [os.path.join(intermediate_dir, f) for f in files], source=series_path,
+                               bones=[strip_extension(f)[:-len('_dynamic_average')] for f in files])
+
+# Opens the catalog of root_dir, indexing the existing tree the first time
+def open_catalog(root_dir, db_path=None):
+    db_path = os.path.join(root_dir, CATALOG_NAME) if db_path is None else db_path
+    is_new = not os.path.exists(db_path)
+    catalog = StudyCatalog(db_path)
+    if is_new:
+        catalog.index_tree(root_dir)
+    return catalog
@@ -3,35 +3,137 @@ import nibabel as nib
 import os
 import time
 from utility_functions import *
+from stage_executor import ThresholdingExecutor
+from result_cache import ResultCache
+from study_catalog import open_catalog
+from volume_storage import (MASK_FORMAT, VOLUME_FORMAT, is_stored_volume, stored_path, strip_extension, save_label_map, read_ahead,
+                            WriteBehind)
 
 root_dir = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/lunar_quant"
-length = len(root_dir)
-if __name__ == "__main__":
+volume_cache = VolumeCache(max_bytes=8 * 1024**3)
+n_workers = 8
+# Parameters of the stage, they are part of the cache key of every output
+THRESHOLDING_PARAMS = {'offset': 0, 'mode': 'average', 'opening': 'scipy', 'lower_threshold': LOWER_THRESHOLD,
+                       'average_weights': AVERAGE_WEIGHTS, 'erosion_iterations': 1}
+
+# Runs full_pipeline for every bone mask of segmentation_dir on the CT at file_path, in a single process
+# The outputs are written to output_dir with the segmentation file name ending in output_suffix
+# With use_cache, bones whose CT, mask and parameters are unchanged since their last run are skipped
+# The next masks are read while a bone is processed and its result is written in the background (see read_ahead and WriteBehind)
+def threshold_study(file_path, segmentation_dir, output_dir, output_suffix='_dynamic_average.nii.gz', volume_cache=volume_cache,
+                    use_cache=True):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    volume_cache.start_study(file_path)
+    result_cache = ResultCache(os.path.dirname(file_path), 'thresholding_morphology') if use_cache else None
+    output_paths = []
+    tasks = {}
+    keys = {}
+    for segmentation in os.listdir(segmentation_dir):
+        if not is_stored_volume(segmentation):
+            continue
+        bone_mask_path = os.path.join(segmentation_dir, segmentation)
+        output_path = stored_path(os.path.join(output_dir, strip_extension(segmentation) + output_suffix), MASK_FORMAT)
+        output_paths.append(output_path)
+        if result_cache is not None:
+            keys[output_path] = result_cache.key([file_path, bone_mask_path], THRESHOLDING_PARAMS)
+            if result_cache.is_up_to_date(output_path, keys[output_path]):
+                continue
+        tasks[bone_mask_path] = output_path
+
+    # A bone is recorded in the cache once its file is written, the cache is saved once for the study (failed or not)
+    def record(output_path):
+        if result_cache is not None:
+            result_cache.record(output_path, keys[output_path])
 
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith('.nii') or file.endswith('.nii.gz') and 'CT' in file:
-                
-                file_path = os.path.join(subdir,file)
+    try:
+        with WriteBehind(done=record) as writer:
+            for bone_mask_path, bone_mask in read_ahead(tasks, load_bone_mask):
+                full_pipeline(file_path, bone_mask_path, tasks[bone_mask_path], THRESHOLDING_PARAMS['offset'], THRESHOLDING_PARAMS['mode'],
+                              THRESHOLDING_PARAMS['opening'], volume_cache=volume_cache, crop=True,
+                              erosion_iterations=THRESHOLDING_PARAMS['erosion_iterations'], bone_mask=bone_mask, writer=writer)
+    finally:
+        if result_cache is not None and tasks:
+            result_cache.save()
+    return output_paths
 
-                segmentation_dir = os.path.join(subdir, file.replace('.nii.gz','_segmentation'))
-                if not os.path.exists(segmentation_dir):
-                    print("Bone segmentations not found for: ", file_path)
-                    continue
+# Same stage, writing a single uint8 label map (output_dir/dynamic_average_labels, one label per bone in the order of the
+# sorted mask files, names in the .json side table) instead of one file per bone
+# With save_bone_masks, the per-bone files of threshold_study are written as well
+# Returns the paths written, the label map first, and raises a ValueError when segmentation_dir holds no bone mask
+def threshold_study_label_map(file_path, segmentation_dir, output_dir, output_suffix='_dynamic_average.nii.gz', volume_cache=volume_cache,
+                              use_cache=True, save_bone_masks=False):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    volume_cache.start_study(file_path)
+    bone_mask_paths = sorted(os.path.join(segmentation_dir, f) for f in os.listdir(segmentation_dir) if is_stored_volume(f))
+    if not bone_mask_paths:
+        raise ValueError(f"No bone masks found in {segmentation_dir}")
+    names = {label: strip_extension(os.path.basename(path)) for label, path in enumerate(bone_mask_paths, start=1)}
+    output_path = stored_path(os.path.join(output_dir, 'dynamic_average_labels.nii.gz'), VOLUME_FORMAT)
+    bone_output_paths = [stored_path(os.path.join(output_dir, names[label] + output_suffix), MASK_FORMAT) for label in names]
+    output_paths = [output_path] + (bone_output_paths if save_bone_masks else [])
+    result_cache = ResultCache(os.path.dirname(file_path), 'thresholding_morphology') if use_cache else None
+    if result_cache is not None:
+        key = result_cache.key([file_path] + bone_mask_paths, dict(THRESHOLDING_PARAMS, save_bone_masks=save_bone_masks))
+        if all(result_cache.is_up_to_date(path, key) for path in output_paths):
+            return output_paths
 
-                segmentation_list = os.listdir(segmentation_dir)
+    image_array = volume_cache.get(file_path)
+    label_map = None
+    with WriteBehind() as writer:
+        for label, (bone_mask_path, (bone_mask, bone_mask_array)) in enumerate(read_ahead(bone_mask_paths, load_bone_mask), start=1):
+            if label_map is None:
+                label_map = np.zeros(bone_mask_array.shape[:3], dtype=np.uint8)
+            marrow, bbox = segment_bone_marrow(image_array, bone_mask_array, THRESHOLDING_PARAMS['offset'], THRESHOLDING_PARAMS['mode'],
+                                               THRESHOLDING_PARAMS['opening'], crop=True,
+                                               erosion_iterations=THRESHOLDING_PARAMS['erosion_iterations'])
+            # Marrow masks lie inside their bone masks, which don't overlap, so every voxel gets at most one label
+            region = label_map if bbox is None else label_map[bbox]
+            region[marrow.view(bool)] = label
+            if save_bone_masks:
+                full_mask = np.zeros(label_map.shape, dtype=np.uint8)
+                full_mask[bbox if bbox is not None else ...] = marrow
+                writer.submit(bone_output_paths[label - 1], save_masks, header_processing(full_mask, bone_mask), bone_output_paths[label - 1])
+        save_label_map(label_map, names, bone_mask.affine, bone_mask.header, output_path)
+    if result_cache is not None:
+        for path in output_paths:
+            result_cache.record(path, key)
+        result_cache.save()
+    return output_paths
+
+if __name__ == "__main__":
 
-                intermediate_dir = os.path.join(subdir, file.replace('.nii.gz','_intermediate'))
-                if not os.path.exists(intermediate_dir):
-                    os.makedirs(intermediate_dir)
-                # if os.path.exists(intermediate_dir) and len(os.listdir(intermediate_dir)) > 0:
-                #     print("Intermediate directory already exists for: ", file_path)
-                #     continue
+    executor = ThresholdingExecutor(n_workers, volume_cache=volume_cache)
+    catalog = open_catalog(root_dir)
+    submitted = []
+    for file_path in catalog.series(modality='CT'):
+        subdir = os.path.dirname(file_path)
+        bone_mask_paths = catalog.artifacts('bone_mask', source=file_path)
+        if not bone_mask_paths:
+            print("Bone segmentations not found for: ", file_path)
+            continue
+        volume_cache.start_study(subdir)
 
-                for segmentation in segmentation_list:
-                    print("Processing file: ", segmentation)
+        intermediate_dir = file_path.replace('.nii.gz','_intermediate')
+        if not os.path.exists(intermediate_dir):
+            os.makedirs(intermediate_dir)
+        # Bones already up to date with their inputs and THRESHOLDING_PARAMS are skipped
+        result_cache = ResultCache(subdir, 'thresholding_morphology')
 
-                    output_path = os.path.join(intermediate_dir, segmentation.replace('.nii.gz','_dynamic_average.nii.gz'))
-                    image_array = nib.load(file_path).get_fdata()
-                    full_pipeline(image_array, os.path.join(segmentation_dir, segmentation), output_path, length, 0, 'average', 'scipy')
+        tasks = []
+        for bone_mask_path in bone_mask_paths:
+            output_path = stored_path(os.path.join(intermediate_dir, strip_extension(os.path.basename(bone_mask_path)) + '_dynamic_average.nii.gz'),
+                                      MASK_FORMAT)
+            tasks.append((bone_mask_path, output_path))
+        submitted.append((file_path, tasks))
+        print("Submitting", len(tasks), "bones for: ", file_path)
+        executor.submit_study(file_path, tasks, THRESHOLDING_PARAMS['offset'], THRESHOLDING_PARAMS['mode'],
+                              THRESHOLDING_PARAMS['opening'], crop=True, erosion_iterations=THRESHOLDING_PARAMS['erosion_iterations'],
+                              result_cache=result_cache, cache_params=THRESHOLDING_PARAMS)
+    executor.shutdown()
+    failed = {bone_mask_path for bone_mask_path, _ in executor.errors}
+    for file_path, tasks in submitted:
+        catalog.add_artifacts(os.path.dirname(file_path), 'dynamic_average', [output_path for bone_mask_path, output_path in tasks if bone_mask_path not in failed],
+                              source=file_path, bones=[catalog.bone(bone_mask_path) for bone_mask_path, _ in tasks if bone_mask_path not in failed])
 
@@ -3,37 +3,49 @@ import nibabel as nib
 import os
 import time
 from utility_functions import *
+from stage_executor import ThresholdingExecutor
+from result_cache import ResultCache
+from study_catalog import open_catalog
+from thresholding_morphology import THRESHOLDING_PARAMS
+from volume_storage import MASK_FORMAT, stored_path, strip_extension
 
 root_dir = "/radraid/apps/personal/tfrigerio/bone_marrow_project_stuff/rt_struct_out/"
-length = len(root_dir)
+volume_cache = VolumeCache(max_bytes=8 * 1024**3)
+n_workers = 8
 if __name__ == "__main__":
     t0 = time.time()
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith('.nii') or file.endswith('.nii.gz') and 'CT' in file:
-                
-                file_path = os.path.join(subdir,file)
+    executor = ThresholdingExecutor(n_workers, volume_cache=volume_cache)
+    catalog = open_catalog(root_dir)
+    submitted = []
+    for file_path in catalog.series(modality='CT'):
+        subdir = os.path.dirname(file_path)
+        bone_mask_paths = catalog.artifacts('bone_mask', source=file_path)
+        if not bone_mask_paths:
+            print("Bone segmentations not found for: ", file_path)
+            continue
+        volume_cache.start_study(subdir)
 
-                segmentation_dir = os.path.join(subdir, file.replace('.nii.gz','_segmentation'))
-                if not os.path.exists(segmentation_dir):
-                    print("Bone segmentations not found for: ", file_path)
-                    continue
+        intermediate_dir = os.path.join(subdir, "marrow_segmentation")
+        if not os.path.exists(intermediate_dir):
+            os.makedirs(intermediate_dir)
+        # Bones already up to date with their inputs and THRESHOLDING_PARAMS are skipped
+        result_cache = ResultCache(subdir, 'thresholding_morphology_ct_only')
 
-                segmentation_list = os.listdir(segmentation_dir)
-
-                intermediate_dir = os.path.join(subdir, "marrow_segmentation")
-                if not os.path.exists(intermediate_dir):
-                    os.makedirs(intermediate_dir)
-                if os.path.exists(intermediate_dir) and len(os.listdir(intermediate_dir)) > 0:
-                    print("Intermediate directory already exists for: ", file_path)
-                    continue
-
-                for segmentation in segmentation_list:
-                    print("Processing file: ", segmentation)
-
-                    output_path = os.path.join(intermediate_dir, segmentation.replace('.nii.gz','_marrow.nii.gz'))
-                    image_array = nib.load(file_path).get_fdata()
-                    full_pipeline(image_array, os.path.join(segmentation_dir, segmentation), output_path, length, 0, 'average', 'scipy')
+        tasks = []
+        for bone_mask_path in bone_mask_paths:
+            output_path = stored_path(os.path.join(intermediate_dir, strip_extension(os.path.basename(bone_mask_path)) + '_marrow.nii.gz'),
+                                      MASK_FORMAT)
+            tasks.append((bone_mask_path, output_path))
+        submitted.append((file_path, tasks))
+        print("Submitting", len(tasks), "bones for: ", file_path)
+        executor.submit_study(file_path, tasks, THRESHOLDING_PARAMS['offset'], THRESHOLDING_PARAMS['mode'],
+                              THRESHOLDING_PARAMS['opening'], crop=True, erosion_iterations=THRESHOLDING_PARAMS['erosion_iterations'],
+                              result_cache=result_cache, cache_params=THRESHOLDING_PARAMS)
+    executor.shutdown()
+    failed = {bone_mask_path for bone_mask_path, _ in executor.errors}
+    for file_path, tasks in submitted:
+        catalog.add_artifacts(os.path.dirname(file_path), 'marrow', [output_path for bone_mask_path, output_path in tasks if bone_mask_path not in failed],
+                              source=file_path, bones=[catalog.bone(bone_mask_path) for bone_mask_path, _ in tasks if bone_mask_path not in failed])
 
     t1 = time.time()
     print("Time: ", t1-t0)
\ No newline at end of file
@@ -1,24 +1,93 @@
+import os
 import numpy as np 
 import nibabel as nib
-from scipy.ndimage import binary_opening, binary_erosion
+from scipy.ndimage import binary_opening, binary_erosion, generate_binary_structure, find_objects
 import time
+from collections import OrderedDict
+from volume_storage import load_image, load_mask, save_mask, mask_image, strip_extension
+from instrumentation import span, tags
 
 
+# Flat structuring element for the cortical wall erosion: the 2D cross on a single axial slice, so nothing is eroded along z
+IN_PLANE_STRUCTURE = generate_binary_structure(2, 1)[:, :, np.newaxis]
+
+# Lower HU bound of the marrow, and weights of the 5th and 95th percentiles for the 'average' upper threshold
+LOWER_THRESHOLD = -100
+AVERAGE_WEIGHTS = (0.7, 0.3)
+
 HEADER_KEYS = ['pixdim', 'xyzt_units', 'qform_code', 'sform_code', 'quatern_b', 'quatern_c', 'quatern_d', 'qoffset_x', 'qoffset_y', 'qoffset_z', 'srow_x', 'srow_y', 'srow_z']
 
-# Loading the bone mask as a nifti image and as an array
+# Loading an image volume in its stored dtype (e.g. int16 for CT) instead of promoting it to float64
+def load_native_array(image_path):
+    return load_image(image_path)
+
+# Study-scoped cache of decoded volumes, so a CT shared by every bone of a study is only read once
+# Volumes are evicted least recently used first once max_bytes is exceeded, and everything from the
+# previous study is dropped when start_study is called with a new study
+class VolumeCache:
+    def __init__(self, max_bytes=8 * 1024**3):
+        self.max_bytes = max_bytes
+        self.study = None
+        self.volumes = OrderedDict()
+        self.nbytes = 0
+
+    def start_study(self, study):
+        if study != self.study:
+            self.clear()
+            self.study = study
+
+    def get(self, image_path):
+        if image_path in self.volumes:
+            self.volumes.move_to_end(image_path)
+            return self.volumes[image_path]
+        _, image_array = load_native_array(image_path)
+        self.volumes[image_path] = image_array
+        self.nbytes += image_array.nbytes
+        # The volume just loaded is always kept, even if it alone exceeds the budget
+        while self.nbytes > self.max_bytes and len(self.volumes) > 1:
+            _, evicted = self.volumes.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return image_array
+
+    # Drops one volume, e.g. once a copy of it is kept elsewhere
+    def evict(self, image_path):
+        image_array = self.volumes.pop(image_path, None)
+        if image_array is not None:
+            self.nbytes -= image_array.nbytes
+
+    def clear(self):
+        self.volumes.clear()
+        self.nbytes = 0
+
+# Loading the bone mask as a nifti image and as a boolean array
 def load_bone_mask(bone_mask_path):
-    bone_mask = nib.load(bone_mask_path)                #the nifti mask is necessary to retain the header information
-    bone_mask_array = bone_mask.get_fdata()
+    bone_mask, bone_mask_array = load_mask(bone_mask_path)    #the nifti mask is necessary to retain the header information
     return bone_mask, bone_mask_array
 
-# Isolating the bone from the image, returning an array with 0 values outside the bone
+# Bounding box of a mask as a tuple of slices, padded by margin voxels and clipped to the array
+# Returns None for an empty mask
+def mask_bounding_box(mask_array, margin=0):
+    bbox = []
+    for axis in range(mask_array.ndim):
+        other_axes = tuple(a for a in range(mask_array.ndim) if a != axis)
+        indices = np.flatnonzero(np.any(mask_array, axis=other_axes))
+        if indices.size == 0:
+            return None
+        bbox.append(slice(max(indices[0] - margin, 0), min(indices[-1] + 1 + margin, mask_array.shape[axis])))
+    return tuple(bbox)
+
+# Bounding box (tuple of slices) grown by margin voxels on every side, clipped to shape
+def pad_bounding_box(bbox, margin, shape):
+    return tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n)) for s, n in zip(bbox, shape))
+
+# Isolating the bone from the image, returning an array with 0 values outside the bone (in the dtype of the image)
 def isolate_bone_on_image(image_array, bone_mask_array):
-    return image_array * bone_mask_array
+    return np.where(bone_mask_array, image_array, 0).astype(image_array.dtype, copy=False)
 
 # Obtaining the upper threshold for the bone marrow segmentation
+# With bone_mask_array None, image_array holds the values of the bone voxels only
 def obtain_upper_threshold(image_array, bone_mask_array, offset, mode):
-    values = image_array[bone_mask_array==1]
+    values = image_array if bone_mask_array is None else image_array[bone_mask_array != 0]
     #Check which thresholding mode is selected
     match mode:
         #For static thresholding, the offset is used as the threshold
@@ -38,89 +107,160 @@ def obtain_upper_threshold(image_array, bone_mask_array, offset, mode):
             if np.any(values) != 0:
                 fifth_percentile = np.percentile(values, 5)
                 ninety_fifth_percentile = np.percentile(values, 95)
-                threshold = (0.7*fifth_percentile + 0.3*ninety_fifth_percentile)
+                threshold = (AVERAGE_WEIGHTS[0]*fifth_percentile + AVERAGE_WEIGHTS[1]*ninety_fifth_percentile)
                 return threshold
             return 0
 
-# Thresholding the bone marrow using the obtained threshold, returning a binary mask
+# Upper thresholds of every label in labels, from a single pass over the label map instead of one gather per bone
+# The voxels of all labels are gathered once and grouped with a stable sort on the label (a radix sort for integer
+# label maps), the percentiles of each group are then those obtain_upper_threshold computes on the bone mask
+# Returns a dict of label -> threshold
+def obtain_upper_thresholds(image_array, label_array, labels, offset, mode):
+    if image_array.shape != label_array.shape and image_array.shape[-1] == 1:
+        image_array = image_array[..., 0]
+    if mode == 'static':
+        return {label: offset for label in labels}
+    label_values = label_array.ravel()
+    voxels = np.flatnonzero(label_values)
+    label_values = label_values[voxels]
+    order = np.argsort(label_values, kind='stable')
+    values = image_array.ravel()[voxels[order]]
+    starts = np.concatenate(([0], np.cumsum(np.bincount(label_values, minlength=max(labels) + 1))))
+    thresholds = {}
+    for label in labels:
+        bone_values = values[starts[label]:starts[label + 1]]
+        thresholds[label] = obtain_upper_threshold(bone_values, None, offset, mode)
+    return thresholds
+
+# Thresholding the bone marrow using the obtained threshold, returning a boolean mask
 def threshold_segmentation_of_bone_marrow(bone_array, threshold_up, threshold_down, bone_mask_array, opening):
-    bone_marrow_array_mask = np.where((bone_array < threshold_up) & (bone_array > threshold_down), 1, 0)*bone_mask_array
-    return bone_marrow_array_mask
+    bone_marrow_array_mask = (bone_array < threshold_up) & (bone_array > threshold_down)
+    return np.logical_and(bone_marrow_array_mask, bone_mask_array, out=bone_marrow_array_mask)
 
 
 #Perform binary opening to get rid of small noise as well as soft tissue just outside of the cortical bone
 def opening_3D(bone_marrow_array_mask, iterations, opening):
     opened = binary_opening(bone_marrow_array_mask, iterations=iterations)
     return opened
+
+#Erode the cortical wall in the x-y plane only (the z plane is avoided due to slice thickness)
+#A single 3D erosion with a flat structuring element, equivalent to eroding every axial slice separately
+def erode_in_plane(bone_marrow_array_mask, structure=IN_PLANE_STRUCTURE, iterations=1):
+    if structure.ndim == 2:
+        structure = structure[:, :, np.newaxis]
+    eroded = binary_erosion(bone_marrow_array_mask, structure=structure, iterations=iterations)
+    return np.logical_and(eroded, bone_marrow_array_mask, out=eroded)
           
 
     
-# The segmented bone's header is inherited by the bone marrow mask
+# The segmented bone's header is inherited by the bone marrow mask, stored as uint8
 def header_processing(bone_marrow_array_mask,bone_mask):
-    nifti_mask = nib.Nifti1Image(bone_marrow_array_mask, affine=None, header=bone_mask.header)
+    nifti_mask = mask_image(bone_marrow_array_mask, affine=None, header=bone_mask.header)
     # This next step shouldn't be necessary, but it seems to prevent some unexpected failures
     for key in HEADER_KEYS:
         nifti_mask.header[key]=bone_mask.header[key]
  
     return nifti_mask
 
-#Saves a nifti image to a .nii.gz file
+#Saves a nifti image in the intermediate mask format (see volume_storage.py), returning the path written
 def save_masks(connected_components, output_path):
-    nib.save(connected_components, output_path)
-
-#Full pipeline applies thresholding to find the bone marrow of a bone mask of specified path onto an image passed as a numpy array
-#There are 3 modes available: 'dynamic', 'static', 'average' with regard to obtaining the upper threshold
+    return save_mask(connected_components, output_path)
 
-def full_pipeline(image_array, bone_mask_path, output_path, length, offset, mode, opening):
-
-    t0 = time.time()
-    bone_mask, bone_mask_array = load_bone_mask(bone_mask_path)
-    t1 = time.time()
-    print('image_shape: ', image_array.shape)
-    print('Time to load image and bone mask: ', t1-t0)
-
-    t2 = time.time()
-    
+#Thresholding and morphology of one bone on arrays, shared by full_pipeline and the in-memory pipeline
+#Returns the bone marrow mask as uint8 and the bounding box it covers when crop=True (None when it covers the whole grid)
+#grid_shape is the shape of the full CT when the arrays passed are already cropped, it decides whether the opening is applied
+#upper_threshold, when given (e.g. from obtain_upper_thresholds), is used instead of computing it from the bone voxels
+def segment_bone_marrow(image_array, bone_mask_array, offset, mode, opening, crop=False,
+                        erosion_structure=IN_PLANE_STRUCTURE, erosion_iterations=1, grid_shape=None, upper_threshold=None):
     if image_array.shape != bone_mask_array.shape:
         if image_array.shape[-1] == 1:
             image_array = image_array[:, :, :, 0]
         else:
             raise ValueError('Image and mask have different shapes')
     
-    t3 = time.time()
-    print('Time to check shapes: ', t3-t2)
-
-    t4 = time.time()
-    bone_array = isolate_bone_on_image(image_array, bone_mask_array)
-    t5 = time.time()
-    print('Time to isolate bone on image: ', t5-t4)
-
-    t6 = time.time()
-    upper_threshold = obtain_upper_threshold(image_array, bone_mask_array, offset, mode)
-    t7 = time.time()
-    print('Time to obtain upper threshold: ', t7-t6)
-
-    t8 = time.time()
-    bone_marrow_array_mask = threshold_segmentation_of_bone_marrow(bone_array, upper_threshold, -100, bone_mask_array, opening)
-    t9 = time.time()
-    print('Time to threshold segmentation of bone marrow: ', t9-t8)
-
-    t10 = time.time()
-    if np.max(np.shape(image_array))>= 100 :
-        bone_marrow_array_mask = opening_3D(bone_marrow_array_mask, 1, opening)
-    t11 = time.time()
-    print('Time to open 3D: ', t11-t10)
-    eroded_bone_array = np.zeros(bone_marrow_array_mask.shape)
-    for slice in range(bone_marrow_array_mask.shape[2]):
-        eroded_bone_array[:,:,slice] = binary_erosion(bone_marrow_array_mask[:,:,slice])
-    bone_marrow_array_mask = eroded_bone_array*bone_marrow_array_mask
-    t12 = time.time()
-    connected_components = header_processing(bone_marrow_array_mask, bone_mask)
-    t13 = time.time()
-    print('Time to process header: ', t13-t12)
-
-    t14 = time.time()
-    save_masks(connected_components, output_path)
-    t15 = time.time()
-    print('Time to save masks: ', t15-t14)
-    return print(bone_mask_path[length:])
\ No newline at end of file
+    # Decided on the full grid so that cropping does not change whether the opening is applied
+    apply_opening = np.max(np.shape(image_array) if grid_shape is None else grid_shape) >= 100
+    bbox = None
+    if crop:
+        # The opening and the in-plane erosion never reach further than their iterations outside the bone,
+        # so padding by that radius keeps the cropped morphology identical to the full grid one
+        bbox = mask_bounding_box(bone_mask_array, margin=1 + erosion_iterations)
+    if bbox is not None:
+        image_array = image_array[bbox]
+        bone_mask_array = bone_mask_array[bbox]
+
+    with span('isolate_bone'):
+        bone_array = isolate_bone_on_image(image_array, bone_mask_array)
+
+    if upper_threshold is None:
+        with span('upper_threshold'):
+            upper_threshold = obtain_upper_threshold(image_array, bone_mask_array, offset, mode)
+
+    with span('threshold'):
+        bone_marrow_array_mask = threshold_segmentation_of_bone_marrow(bone_array, upper_threshold, LOWER_THRESHOLD, bone_mask_array, opening)
+
+    if apply_opening:
+        with span('opening'):
+            bone_marrow_array_mask = opening_3D(bone_marrow_array_mask, 1, opening)
+    # Boolean mask viewed as uint8 (no copy) for saving
+    with span('erosion'):
+        bone_marrow_array_mask = erode_in_plane(bone_marrow_array_mask, erosion_structure, erosion_iterations).view(np.uint8)
+    return bone_marrow_array_mask, bbox
+
+#Marrow masks of every label of a label map (e.g. the TotalSegmentator output) on the image, without per-bone files
+#The thresholds of all labels come from one pass over the label map (obtain_upper_thresholds), each bone is then
+#thresholded and opened/eroded inside its bounding box padded by the morphology radius, found for all labels at once
+#Yields (label, bbox, uint8 mask of the bbox) in the order of labels, bbox and mask are None for labels absent from the map
+def segment_all_bone_marrow(image_array, label_array, labels, offset, mode, opening,
+                            erosion_structure=IN_PLANE_STRUCTURE, erosion_iterations=1, bone_mask=None, writer=None):
+    if image_array.shape != label_array.shape and image_array.shape[-1] == 1:
+        image_array = image_array[..., 0]
+    with span('upper_thresholds', n_labels=len(labels)):
+        thresholds = obtain_upper_thresholds(image_array, label_array, labels, offset, mode)
+        bboxes = find_objects(label_array, max_label=max(labels))
+    for label in labels:
+        bbox = bboxes[label - 1]
+        if bbox is None:
+            yield label, None, None
+            continue
+        bbox = pad_bounding_box(bbox, 1 + erosion_iterations, label_array.shape)
+        with tags(label=int(label)), span('segment_bone_marrow'):
+            mask, _ = segment_bone_marrow(image_array[bbox], label_array[bbox] == label, offset, mode, opening,
+                                          erosion_structure=erosion_structure, erosion_iterations=erosion_iterations,
+                                          grid_shape=label_array.shape, upper_threshold=thresholds[label])
+        yield label, bbox, mask
+
+#Full pipeline applies thresholding to find the bone marrow of a bone mask of specified path onto an image passed as a numpy array
+#There are 3 modes available: 'dynamic', 'static', 'average' with regard to obtaining the upper threshold
+#image_array can also be the path of the image, in which case it is read through volume_cache when one is given
+#With crop=True all thresholding and morphology run inside the bounding box of the bone (padded by the morphology radius),
+#the result is identical to the full grid one and is pasted back on the grid of the CT, the grid every later stage reads
+#erosion_structure and erosion_iterations control the thickness of the cortical wall removed in the x-y plane
+#bone_mask, when given, is the (image, array) pair of load_bone_mask already read (e.g. by read_ahead), and with a writer
+#(a WriteBehind of volume_storage.py) the mask is saved in the background instead of before returning
+#Returns the path of the mask
+
+def full_pipeline(image_array, bone_mask_path, output_path, offset, mode, opening, volume_cache=None, crop=False,
+                  erosion_structure=IN_PLANE_STRUCTURE, erosion_iterations=1, bone_mask=None, writer=None):
+    with tags(bone=strip_extension(os.path.basename(bone_mask_path))), span('full_pipeline'):
+        with span('load'):
+            if isinstance(image_array, str):
+                image_array = volume_cache.get(image_array) if volume_cache is not None else load_native_array(image_array)[1]
+            bone_mask, bone_mask_array = load_bone_mask(bone_mask_path) if bone_mask is None else bone_mask
+
+        with span('segment_bone_marrow'):
+            bone_marrow_array_mask, bbox = segment_bone_marrow(image_array, bone_mask_array, offset, mode, opening, crop,
+                                                               erosion_structure, erosion_iterations)
+        if bbox is not None:
+            full_mask = np.zeros(bone_mask_array.shape[:3], dtype=bone_marrow_array_mask.dtype)
+            full_mask[bbox] = bone_marrow_array_mask
+            bone_marrow_array_mask = full_mask
+        with span('header'):
+            connected_components = header_processing(bone_marrow_array_mask, bone_mask)
+
+        with span('save'):
+            if writer is not None:
+                writer.submit(output_path, save_masks, connected_components, output_path)
+            else:
+                save_masks(connected_components, output_path)
+    return output_path
\ No newline at end of file
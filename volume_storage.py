@@ -0,0 +1,280 @@
+import os
+import json
+import zipfile
+import itertools
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nibabel as nib
+from nibabel.openers import Opener
+
+# On-disk format of the intermediate files written by the stages:
+# 'nii.gz' gzipped NIfTI, 'nii' uncompressed NIfTI (memory mapped when read back),
+# 'packed' chunked store of bit-packed boolean masks (masks only)
+# Final outputs (assembled marrow, RTSTRUCT) are always written as standard files.
+MASK_FORMAT = 'nii.gz'
+VOLUME_FORMAT = 'nii.gz'
+# gzip level of 'nii.gz' and deflate level of the 'packed' chunks (1 is fast, 9 is small)
+# 6 is nibabel's own default. 1 writes a mask about 3x faster, for a file about 1.5x bigger
+COMPRESS_LEVEL = 6
+# Axial slices per chunk of the 'packed' store, a reader of a z range only decompresses the chunks it covers
+CHUNK_SLICES = 16
+
+EXTENSIONS = {'nii.gz': '.nii.gz', 'nii': '.nii', 'packed': '.npz'}
+
+# Path without its storage extension
+def strip_extension(path):
+    for extension in EXTENSIONS.values():
+        if path.endswith(extension):
+            return path[:-len(extension)]
+    return path
+
+def is_stored_volume(path):
+    return any(path.endswith(extension) for extension in EXTENSIONS.values())
+
+# Path of a volume once stored in storage_format, e.g. 'x.nii.gz' -> 'x.npz' for 'packed'
+def stored_path(path, storage_format):
+    return strip_extension(path) + EXTENSIONS[storage_format]
+
+# Existing file for path in any storage format, path itself when there is none
+def find_stored(path):
+    if os.path.exists(path):
+        return path
+    for extension in EXTENSIONS.values():
+        if os.path.exists(strip_extension(path) + extension):
+            return strip_extension(path) + extension
+    return path
+
+# NIfTI image of a boolean mask (or of small counts) stored as uint8, with the geometry of header
+# Boolean masks are viewed as uint8 without a copy, nibabel can't write bool arrays
+def mask_image(mask, affine, header=None):
+    mask = mask.view(np.uint8) if mask.dtype == bool else mask.astype(np.uint8, copy=False)
+    header = nib.Nifti1Header() if header is None else header.copy()
+    header.set_data_dtype(np.uint8)
+    return nib.Nifti1Image(mask, affine, header=header)
+
+# Writes a NIfTI image in storage_format at path (its extension replaced accordingly) and returns the path written
+def save_image(image, path, storage_format='nii.gz', compresslevel=COMPRESS_LEVEL):
+    path = stored_path(path, storage_format)
+    if storage_format == 'packed':
+        # Images built with affine=None keep their geometry in the header only
+        affine = image.affine if image.affine is not None else image.header.get_best_affine()
+        save_packed_mask(np.asanyarray(image.dataobj) != 0, affine, image.header, path, compresslevel)
+    elif storage_format == 'nii.gz':
+        with Opener(path, 'wb', compresslevel=compresslevel) as fileobj:
+            image.to_file_map({'image': nib.FileHolder(filename=path, fileobj=fileobj)})
+    else:
+        nib.save(image, path)
+    return path
+
+def save_mask(image, path):
+    return save_image(image, path, MASK_FORMAT)
+
+def save_volume(image, path):
+    return save_image(image, path, VOLUME_FORMAT)
+
+# Writes a mask as bits packed along x, in chunks of CHUNK_SLICES axial slices deflated separately, together with
+# the affine and NIfTI header needed to write it back as a standard image
+# Slabs are written in order along z, so a mask can be produced and stored without ever being held as a whole
+class PackedMaskWriter:
+    def __init__(self, path, shape, affine, header=None, compresslevel=COMPRESS_LEVEL):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.next_chunk = 0
+        self.archive = zipfile.ZipFile(self.tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        members = {
+            'shape': np.array(shape),
+            'affine': np.asarray(affine, dtype=np.float64),
+            'header': np.frombuffer(header.binaryblock, dtype=np.uint8) if header is not None else np.zeros(0, dtype=np.uint8),
+            'chunk_slices': np.array(CHUNK_SLICES),
+        }
+        for name, array in members.items():
+            self._write_member(name, array)
+
+    def _write_member(self, name, array):
+        with self.archive.open(name + '.npy', 'w') as f:
+            np.lib.format.write_array(f, array)
+
+    # Appends the next slices of the mask, every slab but the last must hold a multiple of CHUNK_SLICES slices
+    def write(self, slab):
+        slab = np.asarray(slab, dtype=bool)
+        for z_start in range(0, slab.shape[2], CHUNK_SLICES):
+            self._write_member(f'chunk_{self.next_chunk}', np.packbits(slab[:, :, z_start:z_start + CHUNK_SLICES], axis=0))
+            self.next_chunk += 1
+
+    def close(self):
+        self.archive.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.archive.close()
+            os.remove(self.tmp_path)
+
+def save_packed_mask(mask, affine, header, path, compresslevel=COMPRESS_LEVEL):
+    with PackedMaskWriter(path, np.shape(mask), affine, header, compresslevel) as writer:
+        writer.write(mask)
+
+# Reads a packed mask as a boolean array, only the chunks overlapping z_range (start, stop) when one is given
+def load_packed_mask(path, z_range=None):
+    with np.load(path) as archive:
+        shape = tuple(archive['shape'])
+        chunk_slices = int(archive['chunk_slices'])
+        z_start, z_stop = (0, shape[2]) if z_range is None else z_range
+        mask = np.zeros(shape[:2] + (z_stop - z_start,) + shape[3:], dtype=bool)
+        for index in range(z_start // chunk_slices, -(-z_stop // chunk_slices)):
+            chunk = np.unpackbits(archive[f'chunk_{index}'], axis=0, count=shape[0]).view(bool)
+            chunk_start = index * chunk_slices
+            low, high = max(z_start, chunk_start), min(z_stop, chunk_start + chunk.shape[2])
+            mask[:, :, low - z_start:high - z_start] = chunk[:, :, low - chunk_start:high - chunk_start]
+        affine = archive['affine']
+        header = nib.Nifti1Header(archive['header'].tobytes()) if archive['header'].size else nib.Nifti1Header()
+    header.set_data_dtype(np.uint8)
+    return mask, affine, header
+
+# Opens a stored NIfTI volume without reading it, slices of image.dataobj then only read (or map) the voxels they cover
+# The file is kept open between slices: gzipped slabs read in order then go on from where the previous one stopped,
+# instead of decompressing the file again from the start for every slice
+def open_image(path, mmap=True):
+    return nib.load(find_stored(path), mmap=mmap, keep_file_open=True)
+
+# Loads a stored volume in its stored dtype (no promotion to float64) with its NIfTI image
+# Uncompressed NIfTI files are memory mapped, packed masks come back as a uint8 image over a boolean array
+def load_image(path, mmap=True):
+    path = find_stored(path)
+    if path.endswith(EXTENSIONS['packed']):
+        mask, affine, header = load_packed_mask(path)
+        return nib.Nifti1Image(mask.view(np.uint8), affine, header=header), mask
+    image = nib.load(path, mmap=mmap)
+    if image.dataobj.slope == 1 and image.dataobj.inter == 0:
+        return image, np.asanyarray(image.dataobj.get_unscaled())
+    return image, np.asanyarray(image.dataobj)
+
+# Multi-label volumes (one label per bone) are stored as uint8 in VOLUME_FORMAT, with a JSON side table
+# of label -> name next to them (same path, .json extension)
+LABEL_MAP_SUFFIX = '_labels'
+
+def label_table_path(path):
+    return strip_extension(path) + '.json'
+
+def is_label_map(path):
+    return strip_extension(path).endswith(LABEL_MAP_SUFFIX)
+
+# Writes a label map and its table of names (dict of label -> name), returns the path written
+def save_label_map(label_map, names, affine, header, path):
+    path = save_volume(mask_image(label_map, affine, header), path)
+    with open(label_table_path(path), 'w') as f:
+        json.dump({str(label): name for label, name in names.items()}, f)
+    return path
+
+# Loads a label map as (image, uint8 array, dict of label -> name)
+def load_label_map(path):
+    image, label_map = load_image(path)
+    with open(label_table_path(find_stored(path))) as f:
+        names = {int(label): name for label, name in json.load(f).items()}
+    return image, label_map, names
+
+# Loads a stored mask as a boolean array
+def load_mask(path, mmap=True):
+    image, array = load_image(path, mmap)
+    if array.dtype != bool:
+        array = array != 0
+    return image, array
+
+# Background I/O of the per-bone loops: read_ahead decodes the next files while the current one is processed and
+# WriteBehind encodes and writes the results while the next ones are processed (gzip runs outside the GIL).
+# Both keep a bounded number of volumes in flight, the loop waits when the bound is reached, and a failed read or
+# write is raised in the loop as a RuntimeError naming the file (the original error chained to it).
+READ_AHEAD = 2
+WRITE_BEHIND = 2
+
+def _io_result(future, action, path):
+    try:
+        return future.result()
+    except Exception as error:
+        raise RuntimeError(f"Failed to {action} {path}: {error}") from error
+
+# Yields (path, read(path)) for every path in order, with the reads of the next ahead paths running in background
+# threads meanwhile: at most ahead + 1 results are held at once, the one yielded included
+# The threads run in a copy of the caller's context, so their spans keep the caller's tags
+def read_ahead(paths, read=load_mask, ahead=READ_AHEAD):
+    paths = iter(paths)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max(ahead, 1)) as executor:
+        def submit(path):
+            pending.append((path, executor.submit(contextvars.copy_context().run, read, path)))
+        try:
+            for path in itertools.islice(paths, max(ahead, 1)):
+                submit(path)
+            while pending:
+                path, future = pending.popleft()
+                if ahead > 0:
+                    for next_path in itertools.islice(paths, 1):
+                        submit(next_path)
+                yield path, _io_result(future, 'read', path)
+                # With ahead=0 the next read only starts once the caller is done with this one
+                if ahead == 0:
+                    for next_path in itertools.islice(paths, 1):
+                        submit(next_path)
+        finally:
+            # The loop stopped early (break or error): reads not started yet are dropped
+            for _, future in pending:
+                future.cancel()
+
+# Runs write calls (e.g. save_mask(image, path)) in background threads, at most max_pending of them unfinished:
+# submit waits for the oldest one beyond that, so the images waiting to be written stay bounded (0 writes synchronously)
+# done(path), when given, is called in the caller's thread once the write of path succeeded (e.g. to record it in a ResultCache)
+# As a context manager, every write is finished when the block exits and the first failure is raised
+class WriteBehind:
+    def __init__(self, max_pending=WRITE_BEHIND, done=None):
+        self.max_pending = max_pending
+        self.done = done
+        self.executor = ThreadPoolExecutor(max_workers=max(max_pending, 1))
+        self.pending = deque()
+
+    # Calls write(*args) in the background, path being the file it writes
+    def submit(self, path, write, *args):
+        self.pending.append((path, self.executor.submit(contextvars.copy_context().run, write, *args)))
+        while len(self.pending) > self.max_pending:
+            self._wait_oldest()
+
+    def _wait_oldest(self):
+        path, future = self.pending.popleft()
+        _io_result(future, 'write', path)
+        if self.done is not None:
+            self.done(path)
+
+    # Waits for every write, the ones after a failure included, then raises the first failure
+    def close(self):
+        error = None
+        while self.pending:
+            try:
+                self._wait_oldest()
+            except Exception as write_error:
+                error = error or write_error
+        self.executor.shutdown()
+        if error is not None:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    # When the with block raises, the writes still pending are waited for and their failures only printed,
+    # so that the error of the block is the one that propagates
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+            return False
+        while self.pending:
+            try:
+                self._wait_oldest()
+            except Exception as write_error:
+                print(write_error)
+        self.executor.shutdown()
+        return False